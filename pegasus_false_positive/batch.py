@@ -0,0 +1,133 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import pathlib
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from pegasus_false_positive import main as single
+from pegasus_false_positive.utils import fileutils
+from pegasus_false_positive.utils.keycache import KeyCache
+
+logger = logging.getLogger("pegasus-false-positive")
+logger.setLevel(logging.DEBUG)
+log_handler = logging.StreamHandler()
+formatter = logging.Formatter('%(processName)s %(levelname)s - %(message)s')
+log_handler.setFormatter(formatter)
+
+
+def setup_logging(debug):
+    if not debug:
+        log_handler.setLevel(logging.INFO)
+    if log_handler not in logger.handlers:
+        logger.addHandler(log_handler)
+
+
+def load_scenario(scenario):
+    """
+    Read a scenario, a json object with the options of the single backup command, e.g. {"insert-sms": "sms.json"}.
+    """
+    if scenario is None:
+        return {}
+    with open(scenario) as f:
+        options = {key.replace('-', '_'): value for key, value in json.load(f).items()}
+
+    known = vars(single.build_parser().parse_args(['backup']))
+    known.pop('backup')
+    unknown = sorted(set(options) - set(known))
+    if unknown:
+        raise ValueError('Unknown scenario options: %s' % ', '.join(unknown))
+    return options
+
+
+def find_backups(patterns):
+    backups = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            path = pathlib.Path(path)
+            if path.is_dir() and path not in backups:
+                backups.append(path)
+            elif not path.is_dir():
+                logger.warning('Skipping %s: not a backup folder', path)
+    return backups
+
+
+def backup_weight(backup_path):
+    # Manifest.db grows with the number of files, so it is a cheap estimate of the work needed by a backup
+    try:
+        return os.path.getsize(backup_path / fileutils.MANIFEST_DB_PATH)
+    except OSError:
+        return 0
+
+
+def run_backup(backup_path, options):
+    args = single.build_parser().parse_args([str(backup_path)])
+    for key, value in options.items():
+        setattr(args, key, value)
+
+    result = {'backup': str(backup_path), 'status': 'ok'}
+    start = time.perf_counter()
+    try:
+        result['timings'] = single.run(args)
+    except (Exception, SystemExit) as e:
+        logger.error('Processing %s: %s', backup_path, e)
+        result['status'] = 'error'
+        result['error'] = str(e) or type(e).__name__
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="pegasus-false-positive-batch",
+                                     description='Inject the same scenario into many backups', exit_on_error=False)
+    parser.add_argument('--debug', action='store_true', help='activate debug mode')
+    parser.add_argument('--scenario', type=str, help='json file with the options applied to every backup')
+    parser.add_argument('--password', type=str, help='Backups Password')
+    parser.add_argument('--key-cache', type=str, help='folder to cache the key derived from the backup password')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='number of backups processed at once')
+    parser.add_argument('--results', type=str, help='jsonl file with the result of every backup, stdout by default')
+    parser.add_argument('backups', type=str, nargs='+', help='iPhone backup folders or glob patterns')
+
+    args = parser.parse_args()
+
+    setup_logging(args.debug)
+
+    options = load_scenario(args.scenario)
+    if args.password:
+        options['password'] = args.password
+    if args.key_cache:
+        options['key_cache'] = args.key_cache
+    # Clear the key cache once for the whole batch, not once per backup
+    if options.pop('clear_key_cache', False) and options.get('key_cache'):
+        KeyCache(options['key_cache']).clear()
+    options['debug'] = args.debug
+
+    # Largest backups first, so the longest jobs do not end up alone at the tail of the run
+    backups = sorted(find_backups(args.backups), key=backup_weight, reverse=True)
+    logger.info('Processing %d backups', len(backups))
+
+    results = open(args.results, 'w') if args.results else sys.stdout
+    failed = 0
+    try:
+        with ProcessPoolExecutor(max_workers=max(args.processes, 1), initializer=setup_logging,
+                                 initargs=(args.debug,)) as executor:
+            futures = [executor.submit(run_backup, backup, options) for backup in backups]
+            for future in as_completed(futures):
+                result = future.result()
+                failed += result['status'] != 'ok'
+                results.write(json.dumps(result) + '\n')
+                results.flush()
+    finally:
+        if results is not sys.stdout:
+            results.close()
+
+    if failed:
+        logger.error('%d of %d backups failed', failed, len(backups))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
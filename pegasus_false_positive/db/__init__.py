@@ -1,13 +1,31 @@
+import contextlib
 import logging
+import sqlite3
+import sys
+import threading
 
 import peewee
 from peewee import SqliteDatabase
 
+from .manifest import MBFile, ManifestCatalog
 from .items import Files, Message, Chat, Handle, ChatHandleJoin, ChatMessageJoin, Urls, HistoryItems, ZProcess, \
     ZLiveUsage, Access, HistoryVisits, Tabs, TabSession, BrowserWindows, IconMapping, FaviconBitmaps, Favicons
 
 __all__ = [
+    'MemoryDatabase',
+    'DatabaseRegistry',
+    'FAST_PRAGMAS',
+    'configure',
+    'mark_copy',
+    'release',
+    'release_all',
+    'session',
+    'max_variables',
+    'insert_many',
     'open_manifest',
+    'get_manifest_catalog',
+    'ManifestCatalog',
+    'MBFile',
     'Files',
     'open_sms',
     'Message',
@@ -35,73 +53,269 @@ __all__ = [
     'BrowserWindows'
 ]
 
-db_sms = None
-db_chrome = None
-db_chrome_favicon = None
-db_safari = None
-db_data_usage = None
-db_manifest = None
-db_tcc = None
-db_safari_state = None
+# Manifest.db and the --in-memory databases are edited through sqlite3 Connection.serialize and deserialize
+if sys.version_info < (3, 11):
+    raise ImportError('pegasus-false-positive needs Python 3.11 or later')
+
+manifest_catalog = None
 
 logger = logging.getLogger('pegasus-false-positive')
 
+# Offsets of the file format write/read version bytes in the SQLite header, 2 means WAL
+SQLITE_FORMAT_VERSION = slice(18, 20)
+SQLITE_LEGACY_FORMAT = b'\x01\x01'
+# Pragmas for databases that are copies thrown away if anything fails: decrypted files, in-memory images and the files
+# of an --output backup. Durability is not needed while editing those
+FAST_PRAGMAS = {
+    'journal_mode': 'memory',
+    'synchronous': 'off',
+    'cache_size': -64 * 1024,
+    'temp_store': 'memory',
+}
+# Pragmas left out for the original backup files edited in place, so a crash never corrupts them
+DURABILITY_PRAGMAS = ('journal_mode', 'synchronous')
+
+
+class MemoryDatabase:
+    """
+    Plaintext image of a SQLite database that is edited in memory instead of on disk. Any open_* helper accepts it
+    in place of a file name; data holds the serialized database after it is released.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.file_format = None
+
+    def connect(self):
+        # SQLite refuses to deserialize WAL databases, so they are loaded as legacy ones and switched back afterwards
+        self.file_format = bytes(self.data[SQLITE_FORMAT_VERSION])
+        data = self.data
+        if self.file_format != SQLITE_LEGACY_FORMAT:
+            data = bytearray(data)
+            data[SQLITE_FORMAT_VERSION] = SQLITE_LEGACY_FORMAT
+
+        sqlite_db = SqliteDatabase(':memory:', thread_safe=False, check_same_thread=False)
+        sqlite_db.connect()
+        try:
+            sqlite_db.connection().deserialize(bytes(data))
+        except BaseException:
+            sqlite_db.close()
+            raise
+        return sqlite_db
+
+    def disconnect(self, sqlite_db):
+        try:
+            data = sqlite_db.connection().serialize()
+        finally:
+            sqlite_db.close()
+
+        if self.file_format != SQLITE_LEGACY_FORMAT:
+            data = bytearray(data)
+            data[SQLITE_FORMAT_VERSION] = self.file_format
+        self.data = bytes(data)
+
+
+class DatabaseHandle:
+    __slots__ = ('database', 'sqlite_db', 'journal_mode', 'models')
+
+    def __init__(self, database, sqlite_db, journal_mode):
+        self.database = database
+        self.sqlite_db = sqlite_db
+        self.journal_mode = journal_mode
+        # Models whose tables are known to exist
+        self.models = set()
+
+
+class DatabaseRegistry:
+    """
+    Databases opened during a run. Each one is connected on its first open and kept open, with pragmas applied, until
+    it is released, so every chunk of records reuses the connection and the tables are only checked once.
+    """
+
+    def __init__(self, pragmas=None):
+        self.pragmas = dict(FAST_PRAGMAS if pragmas is None else pragmas)
+        self.handles = {}
+        self.lock = threading.Lock()
+        # Database files known to be copies, or every file when the whole backup is a copy
+        self.copies = set()
+        self.all_copies = False
+
+    @staticmethod
+    def _key(database):
+        return database if isinstance(database, MemoryDatabase) else str(database)
+
+    def mark_copy(self, database):
+        with self.lock:
+            self.copies.add(self._key(database))
+
+    def _pragmas(self, database):
+        if isinstance(database, MemoryDatabase) or self.all_copies or self._key(database) in self.copies:
+            return self.pragmas
+        return {name: value for name, value in self.pragmas.items() if name not in DURABILITY_PRAGMAS}
+
+    def open(self, database, models):
+        with self.lock:
+            handle = self.handles.get(self._key(database))
+            if handle is None:
+                handle = self.handles[self._key(database)] = self._connect(database)
+
+        handle.sqlite_db.bind(models)
+        missing = [model for model in models if model not in handle.models]
+        if missing:
+            handle.sqlite_db.create_tables(missing)
+            handle.models.update(missing)
+        return contextlib.nullcontext(handle.sqlite_db)
+
+    def _connect(self, database):
+        if isinstance(database, MemoryDatabase):
+            sqlite_db = database.connect()
+        else:
+            sqlite_db = SqliteDatabase(database, thread_safe=False, check_same_thread=False)
+            sqlite_db.connect()
+
+        try:
+            journal_mode = sqlite_db.execute_sql('PRAGMA journal_mode').fetchone()[0]
+            for name, value in self._pragmas(database).items():
+                sqlite_db.execute_sql('PRAGMA %s = %s' % (name, value))
+        except BaseException:
+            sqlite_db.close()
+            raise
+        return DatabaseHandle(database, sqlite_db, journal_mode)
+
+    def release(self, database):
+        """
+        Close a database, restoring its journal mode so a WAL database is left as a WAL database.
+        """
+        with self.lock:
+            handle = self.handles.pop(self._key(database), None)
+            self.copies.discard(self._key(database))
+        if handle is None:
+            return
+
+        if isinstance(database, MemoryDatabase):
+            database.disconnect(handle.sqlite_db)
+            return
+        try:
+            handle.sqlite_db.execute_sql('PRAGMA journal_mode = %s' % handle.journal_mode)
+        finally:
+            handle.sqlite_db.close()
+
+    def release_all(self):
+        with self.lock:
+            databases = [handle.database for handle in self.handles.values()]
+        for database in databases:
+            self.release(database)
+
+
+registry = DatabaseRegistry()
+
+
+def configure(pragmas, copies=False):
+    """
+    Set the pragmas applied to the databases opened from now on. copies tells that every database file is a copy, so
+    the durability pragmas are applied to all of them.
+    """
+    registry.pragmas = dict(pragmas)
+    registry.all_copies = copies
+
+
+def mark_copy(database):
+    """
+    Tell that a database file is a copy, e.g. a decrypted one, so it is edited with every pragma.
+    """
+    registry.mark_copy(database)
+
+
+def release(database):
+    registry.release(database)
+
+
+def release_all():
+    registry.release_all()
+
+
+@contextlib.contextmanager
+def session(pragmas, copies=False):
+    """
+    Scope of a run: the databases opened inside are edited with pragmas and released, if still open, on exit.
+    """
+    configure(pragmas, copies)
+    try:
+        yield registry
+    finally:
+        registry.release_all()
+
+
+def max_variables(model):
+    """
+    Most bound variables allowed in a statement by the SQLite library the database of model is connected with.
+    """
+    return model._meta.database.connection().getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+
+
+def insert_many(model, rows, **on_conflict):
+    """
+    Insert a list of row dicts with as few INSERT statements as the SQLite bound variables limit allows. on_conflict
+    holds the arguments of an ON CONFLICT clause, e.g. conflict_target and update for an upsert.
+    """
+    if not rows:
+        return
+    batch_size = max(max_variables(model) // len(rows[0]), 1)
+    for batch in peewee.chunked(rows, batch_size):
+        query = model.insert_many(batch)
+        if on_conflict:
+            query = query.on_conflict(**on_conflict)
+        query.execute()
+
 
 def open_manifest(database):
+    global manifest_catalog
     try:
-        db_manifest = SqliteDatabase(database)
-        db_manifest.bind([Files])
-        db_manifest.create_tables([Files])
-        return db_manifest.connection_context()
-    except peewee.DatabaseError as e:
+        context = registry.open(database, [Files])
+    except (peewee.DatabaseError, sqlite3.DatabaseError) as e:
         logger.error("Opening Manifest.db: %s", e)
         exit()
+    manifest_catalog = ManifestCatalog()
+    return _manifest_context(database, context, manifest_catalog)
+
+
+@contextlib.contextmanager
+def _manifest_context(database, context, catalog):
+    try:
+        with context:
+            yield catalog
+            catalog.flush()
+    finally:
+        registry.release(database)
+
+
+def get_manifest_catalog():
+    return manifest_catalog
 
 
 def open_sms(database):
-    db_sms = SqliteDatabase(database)
-    db_sms.bind([Message, Chat, Handle, ChatMessageJoin, ChatHandleJoin])
-    db_sms.create_tables([Message, Chat, Handle, ChatMessageJoin, ChatHandleJoin])
-    return db_sms.connection_context()
+    return registry.open(database, [Message, Chat, Handle, ChatMessageJoin, ChatHandleJoin])
 
 
 def open_chrome(database):
-    db_chrome = SqliteDatabase(database)
-    db_chrome.bind([Urls])
-    db_chrome.create_tables([Urls])
-    return db_chrome.connection_context()
+    return registry.open(database, [Urls])
 
 
 def open_safari(database):
-    db_safari = SqliteDatabase(database)
-    db_safari.bind([HistoryItems, HistoryVisits])
-    db_safari.create_tables([HistoryItems, HistoryVisits])
-    return db_safari.connection_context()
+    return registry.open(database, [HistoryItems, HistoryVisits])
 
 
 def open_data_usage(database):
-    db_data_usage = SqliteDatabase(database)
-    db_data_usage.bind([ZProcess, ZLiveUsage])
-    db_data_usage.create_tables([ZProcess, ZLiveUsage])
-    return db_data_usage.connection_context()
+    return registry.open(database, [ZProcess, ZLiveUsage])
 
 
 def open_tcc(database):
-    db_tcc = SqliteDatabase(database)
-    db_tcc.bind([Access])
-    db_tcc.create_tables([Access])
-    return db_tcc.connection_context()
+    return registry.open(database, [Access])
 
 
 def open_safari_state(database):
-    db_safari_state = SqliteDatabase(database)
-    db_safari_state.bind([Tabs, TabSession, BrowserWindows])
-    db_safari_state.create_tables([Tabs, TabSession, BrowserWindows])
-    return db_safari_state.connection_context()
+    return registry.open(database, [Tabs, TabSession, BrowserWindows])
 
 
 def open_chrome_favicon(database):
-    db_chrome_favicon = SqliteDatabase(database)
-    db_chrome_favicon.bind([IconMapping, Favicons, FaviconBitmaps])
-    db_chrome_favicon.create_tables([IconMapping, Favicons, FaviconBitmaps])
-    return db_chrome_favicon.connection_context()
+    return registry.open(database, [IconMapping, Favicons, FaviconBitmaps])
@@ -217,7 +217,7 @@ class HistoryItems(Model):
         db_table = 'history_items'
 
     id = AutoField(primary_key=True)
-    url = CharField()
+    url = CharField(unique=True)
     domain_expansion = CharField()
     visit_count = IntegerField()
     daily_visit_counts = BlobField()
@@ -346,10 +346,6 @@ class Tabs(Model):
     def get_by_order_index(cls):
         return cls.select().order_by(cls.order_index).get()
 
-    @classmethod
-    def update_order_index(cls, order_index):
-        return cls.update(order_index=order_index + 1).where(cls.order_index >= order_index).execute()
-
 
 class TabSession(Model):
     class Meta:
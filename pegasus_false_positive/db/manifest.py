@@ -0,0 +1,138 @@
+import pathlib
+import plistlib
+
+from .items import Files
+from ..utils import bplist
+
+FILES_UPSERT = ('INSERT INTO Files (fileID, domain, relativePath, flags, file) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT (fileID) DO UPDATE SET file = excluded.file')
+
+
+class MBFile:
+    """
+    Manifest.db Files row with its NSKeyedArchiver MBFile blob already decoded.
+    """
+    __slots__ = ('file_id', 'domain', 'relative_path', 'flags', 'attrs', 'blob', 'dirty', 'new')
+
+    def __init__(self, file_id, domain, relative_path, flags, attrs, blob=None, new=False):
+        self.file_id = file_id
+        self.domain = domain
+        self.relative_path = relative_path
+        self.flags = flags
+        self.attrs = attrs
+        # Encoded attrs, kept in sync by update() so unchanged layouts are never re-encoded
+        self.blob = blob
+        self.dirty = new
+        self.new = new
+
+    @classmethod
+    def from_row(cls, row):
+        blob = bytes(row.file)
+        return cls(row.fileID, row.domain, row.relativePath, row.flags,
+                   plistlib.loads(blob, fmt=plistlib.FMT_BINARY), blob=blob)
+
+    @property
+    def full_path(self):
+        return pathlib.Path(self.file_id[:2]) / self.file_id
+
+    def _digest_index(self):
+        uid = self.attrs['$objects'][1].get('Digest')
+        return uid.data if isinstance(uid, plistlib.UID) else None
+
+    @property
+    def digest(self):
+        """
+        SHA-1 of the file, or None when the record has no Digest, as many files of recent backups.
+        """
+        index = self._digest_index()
+        if index is None:
+            return None
+        digest = self.attrs['$objects'][index]
+        return digest if isinstance(digest, bytes) else None
+
+    @property
+    def size(self):
+        return self.attrs['$objects'][1]['Size']
+
+    def update(self, digest, size):
+        """
+        Set the Size and the Digest of the record. Records without a Digest are left without one.
+        """
+        index = self._digest_index()
+        if index is not None:
+            self.attrs['$objects'][index] = digest
+        self.attrs['$objects'][1]['Size'] = size
+        if self.blob is not None:
+            self.blob = bplist.patch_mbfile(self.blob, digest, size)
+        self.dirty = True
+
+    def encode(self):
+        if self.blob is None:
+            self.blob = plistlib.dumps(self.attrs, fmt=plistlib.FMT_BINARY)
+        return self.blob
+
+
+class ManifestCatalog:
+    """
+    Cache of the Manifest.db records used in a run, indexed by relativePath, fileID and domain. Every row is queried
+    and decoded once; modified records are written back together by flush().
+    """
+
+    def __init__(self):
+        self.by_relative_path = {}
+        self.by_file_id = {}
+        self.by_domain = {}
+        self.loaded_domains = set()
+
+    def _index(self, record):
+        if record.file_id in self.by_file_id:
+            return self.by_file_id[record.file_id]
+        self.by_file_id[record.file_id] = record
+        self.by_relative_path.setdefault(record.relative_path, record)
+        self.by_domain.setdefault(record.domain, []).append(record)
+        return record
+
+    def get_by_relative_path(self, relative_path):
+        if relative_path not in self.by_relative_path:
+            row = Files.get_or_none(Files.relativePath == relative_path)
+            if row is None:
+                return None
+            self._index(MBFile.from_row(row))
+        return self.by_relative_path[relative_path]
+
+    def get_by_file_id(self, file_id):
+        if file_id not in self.by_file_id:
+            row = Files.get_or_none(Files.fileID == file_id)
+            if row is None:
+                return None
+            self._index(MBFile.from_row(row))
+        return self.by_file_id[file_id]
+
+    def get_by_domain(self, domain):
+        if domain not in self.loaded_domains:
+            for row in Files.select().where(Files.domain == domain):
+                if row.fileID not in self.by_file_id:
+                    self._index(MBFile.from_row(row))
+            self.loaded_domains.add(domain)
+        return self.by_domain.get(domain, [])
+
+    def add(self, file_id, domain, relative_path, flags, attrs):
+        return self._index(MBFile(file_id, domain, relative_path, flags, attrs, new=True))
+
+    def flush(self):
+        """
+        Write every new or modified record with a single executemany in one transaction.
+        """
+        dirty = [record for record in self.by_file_id.values() if record.dirty]
+        if not dirty:
+            return
+
+        rows = [(record.file_id, record.domain, record.relative_path, record.flags, record.encode())
+                for record in dirty]
+        database = Files._meta.database
+        with database.atomic():
+            database.connection().executemany(FILES_UPSERT, rows)
+
+        for record in dirty:
+            record.dirty = False
+            record.new = False
@@ -0,0 +1,42 @@
+import functools
+import importlib
+
+# IOC name: (module, class), in the order they are run. The modules are only imported when their IOC is used, so a run
+# does not pay for the dependencies of the IOCs it does not inject
+IOCS = {
+    'sms': ('sms', 'Sms'),
+    'osad': ('osad', 'Osad'),
+    'tcc': ('tcc', 'Tcc'),
+    'file': ('file', 'File'),
+    'data_usage': ('data_usage', 'DataUsage'),
+    'safari': ('safari_history', 'SafariHistory'),
+    'safari_state': ('safari_state', 'SafariState'),
+    'chrome': ('chrome_history', 'ChromeHistory'),
+    'chrome_favicon': ('chrome_favicon', 'ChromeFavicon'),
+    'process': ('process', 'Process'),
+}
+
+# IOCs that can be fed from the "ioc" field of a --insert-records file
+STREAM_IOCS = tuple(name for name in IOCS if name != 'file')
+
+
+@functools.lru_cache(maxsize=None)
+def load(name):
+    """
+    Import the class of the IOC called name. Raises KeyError for unknown IOCs.
+    """
+    module, class_name = IOCS[name]
+    return getattr(importlib.import_module('.' + module, __name__), class_name)
+
+
+def create(name, backup_path, file_locator, config_file, in_memory=False):
+    ioc_class = load(name)
+    if ioc_class.IN_MEMORY:
+        return ioc_class(backup_path, file_locator, config_file, in_memory=in_memory)
+    return ioc_class(backup_path, file_locator, config_file)
+
+
+def required_fields(name):
+    if name not in STREAM_IOCS:
+        raise KeyError(name)
+    return load(name).REQUIRED_FIELDS
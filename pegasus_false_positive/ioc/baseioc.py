@@ -1,61 +1,156 @@
 import binascii
-import hashlib
 import json
 import logging
 import os.path
 import pathlib
 import plistlib
-from io import BytesIO
 
 from pegasus_false_positive import db
 from pegasus_false_positive.db import Files
+from pegasus_false_positive.utils import fileutils
 
 MANIFEST = "Manifest.db"
 
 logger = logging.getLogger('pegasus-false-positive')
 
 
-def calculate_digest(filename):
-    m = hashlib.sha1()
-    with open(filename, "rb") as f:
-        m.update(f.read())
-    return m.digest()
-
-
 class BaseIOC:
+    # Fields every record of the IOC must have, checked when records are streamed from a JSON Lines file
+    REQUIRED_FIELDS = ()
+    # Whether the IOC takes the in_memory option, i.e. it edits a SQLite database
+    IN_MEMORY = True
 
-    def __init__(self, backup_path, file_locator):
+    def __init__(self, backup_path, file_locator, in_memory=False):
         self.backup_path = backup_path
         self.file_locator = file_locator
         self.filename = None
         self.attrs = None
+        self.record = None
+        self.config_file = None
+        self.records = []
+        self.in_memory = in_memory
+        self.database = None
+        self.manifest_updates = []
+        self.defer_manifest_updates = False
 
     @staticmethod
     def params_file_to_dict(filename):
         with open(filename) as json_file:
             return json.load(json_file)
 
-    def get_file_name(self, relative_path):
-        return pathlib.Path(self.backup_path) / Files.full_path(relative_path)
+    def load_records(self, config_file):
+        """
+        Load the records of a config file, which holds either a single record or a list of them. Without config file
+        the IOC starts empty and its records are given by insert_chunk.
+        """
+        if config_file is None:
+            return
+        data = self.params_file_to_dict(config_file)
+        self.config_file = config_file
+        self.records = data if isinstance(data, list) else [data]
 
-    @staticmethod
-    def update_manifest_file(relative_path, filename, size):
-        f = Files.get(Files.relativePath == relative_path)
-        if f is not None:
-            plist_data = plistlib.load(BytesIO(f.file), fmt=plistlib.FMT_BINARY)
-            logger.debug(binascii.hexlify(plist_data['$objects'][3]))
-            plist_data['$objects'][3] = calculate_digest(filename)
-            plist_data['$objects'][1]['Size'] = size
-            logger.debug(binascii.hexlify(plist_data['$objects'][3]))
-            f.file = plistlib.dumps(plist_data, fmt=plistlib.FMT_BINARY)
-            f.save()
-
-            logger.debug('Updated digest of %s in Manifest.db', filename.name)
+    def insert_chunk(self, records):
+        """
+        Insert a chunk of streamed records through the insert_records method of the IOC. The backup file is decrypted
+        before the first chunk, and is only written back by finish_chunks.
+        """
+        if self.database is None:
+            self.decrypt_if_needed()
+        self.records = records
+        self.insert_records()
+
+    def finish_chunks(self):
+        # Nothing to write back if the file was never decrypted
+        if self.database is None:
+            return
+        digest, size = self.crypt_if_needed()
+        self.update_manifest_file(size, digest)
+
+    def load_manifest_record(self, relative_path):
+        self.record = db.get_manifest_catalog().get_by_relative_path(relative_path)
+        if self.record is None:
+            raise Files.DoesNotExist(relative_path)
+        self.filename = pathlib.Path(self.backup_path) / self.record.full_path
+        self.attrs = self.record.attrs
+
+    def update_manifest_file(self, size, digest):
+        self.manifest_updates.append((self.record, size, digest))
+        if not self.defer_manifest_updates:
+            self.apply_manifest_updates()
+
+    def apply_manifest_updates(self):
+        """
+        Apply the queued Manifest updates. IOCs run by the scheduler defer them so that only the thread owning
+        Manifest.db touches it.
+        """
+        for record, size, digest in self.manifest_updates:
+            logger.debug(record.digest and binascii.hexlify(record.digest))
+            record.update(digest, size)
+            logger.debug(record.digest and binascii.hexlify(record.digest))
+
+            logger.debug('Updated digest of %s in Manifest.db', record.file_id)
+        self.manifest_updates = []
 
     def decrypt_if_needed(self):
-        if self.file_locator is not None:
+        if self.in_memory:
+            if self.file_locator is not None:
+                data = self.file_locator.read_file(self.filename, self.attrs)
+            else:
+                with open(self.filename, 'rb') as f:
+                    data = f.read()
+            self.database = db.MemoryDatabase(data)
+            return
+
+        # database is only set once the file is ready to edit, so a file that failed to decrypt is never written back
+        if self.file_locator is not None and fileutils.get_encryption_key(self.attrs) is not None:
+            # Decrypting writes a new file, so the original one is never edited
             self.file_locator.decrypt_file(self.filename, self.attrs)
+            db.mark_copy(self.filename)
+        else:
+            # SQLite and plists edit the file in place, and --output may have linked it from the original backup
+            fileutils.detach_file(self.filename)
+        self.database = self.filename
 
     def crypt_if_needed(self):
+        """
+        Write back the modified file and return the digest and plaintext size to store in the Manifest.
+        """
+        db.release(self.database)
+        if self.in_memory:
+            if self.file_locator is not None:
+                return self.file_locator.write_file(self.filename, self.attrs, self.database.data)
+            dst = fileutils.replace_file(self.filename, lambda dst: dst.write(self.database.data))
+            return dst.digest(), len(self.database.data)
+
         if self.file_locator is not None:
-            self.file_locator.encrypt_file(self.filename, self.attrs)
+            return self.file_locator.encrypt_file(self.filename, self.attrs)
+        return fileutils.hash_file(self.filename), os.path.getsize(self.filename)
+
+
+class PlistIOC(BaseIOC):
+    """
+    IOC that edits a binary plist. The plist is loaded once, every chunk of records is applied to it in memory, and it
+    is dumped once before the file is written back.
+    """
+    IN_MEMORY = False
+
+    def __init__(self, backup_path, file_locator):
+        super().__init__(backup_path, file_locator)
+        self.plist_data = None
+
+    def load_plist(self):
+        if self.plist_data is None:
+            with open(self.filename, "rb") as f:
+                self.plist_data = plistlib.load(f, fmt=plistlib.FMT_BINARY)
+        return self.plist_data
+
+    def save_plist(self):
+        if self.plist_data is None:
+            return
+        with open(self.filename, "wb") as f:
+            f.write(plistlib.dumps(self.plist_data, fmt=plistlib.FMT_BINARY))
+        self.plist_data = None
+
+    def finish_chunks(self):
+        self.save_plist()
+        super().finish_chunks()
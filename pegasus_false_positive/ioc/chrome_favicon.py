@@ -1,23 +1,34 @@
+import functools
+import hashlib
 import logging
+import pathlib
 from urllib.parse import urlparse
 
+from peewee import JOIN, chunked, fn
+
 from pegasus_false_positive import db
 from pegasus_false_positive.db import Files, Urls, Favicons, IconMapping, FaviconBitmaps
 from .baseioc import BaseIOC
 from ..utils import utils
 
 RELATIVE_PATH = "Library/Application Support/Google/Chrome/Default/Favicons"
+# Icon urls looked up per query when loading the existing icons
+URL_BATCH_SIZE = 500
 logger = logging.getLogger('pegasus-false-positive')
 
 
 class ChromeFavicon(BaseIOC):
-    def __init__(self, backup_path, file_locator, config_file):
-        super().__init__(backup_path, file_locator)
+    REQUIRED_FIELDS = ('url', 'url_ico', 'type', 'last_updated')
+
+    def __init__(self, backup_path, file_locator, config_file, in_memory=False):
+        super().__init__(backup_path, file_locator, in_memory=in_memory)
         self.init = True
+        # Icon ids by url, and by url and image hash, of the icon urls loaded so far. Kept between chunks
+        self.icons = {}
+        self.loaded_urls = set()
         try:
-            self.data = super().params_file_to_dict(config_file)
-            self.filename = super().get_file_name(RELATIVE_PATH)
-            self.attrs = Files.get_file_attributes_by_relative_path(RELATIVE_PATH)
+            super().load_records(config_file)
+            super().load_manifest_record(RELATIVE_PATH)
         except Files.DoesNotExist:
             logger.info("No Chrome Favicon")
             self.init = False
@@ -28,20 +39,75 @@ class ChromeFavicon(BaseIOC):
     def run(self):
         try:
             self.decrypt_if_needed()
-            self.update_chrome_favicon()
-            self.crypt_if_needed()
-            logger.info('Suspicious %s domain inserted in chrome favicon', self.data['url'])
+            self.insert_records()
+            digest, size = self.crypt_if_needed()
+            super().update_manifest_file(size, digest)
+            for record in self.records:
+                logger.info('Suspicious %s domain inserted in chrome favicon', record['url'])
         except Exception as er:
-            logger.error("Inserting Chrome favicon URL %s: %s", self.data['url'], er)
+            logger.error("Inserting Chrome favicon URLs of %s: %s", self.config_file, er)
+
+    def insert_records(self):
+        with db.open_chrome_favicon(self.database) as chrome_favicon_db:
+            with chrome_favicon_db.atomic():
+                self.insert_favicons()
+
+    def insert_favicons(self):
+        """
+        Map every page to its icon. An icon with the same url and image as an existing or already inserted one is
+        reused, so it is stored once and shared by all the pages using it, and every page keeps the icon url of its
+        record.
+        """
+        self.load_icons({record['url_ico'] for record in self.records} - self.loaded_urls)
+
+        next_id = (Favicons.select(fn.MAX(Favicons.id)).scalar() or 0) + 1
+        favicons = []
+        favicon_bitmaps = []
+        icon_mappings = []
+        for record in self.records:
+            image_data = self.load_image(record['image']) if record.get('image') else None
+            key = icon_key(record['url_ico'], image_data)
+            icon_id = self.icons.get(key)
+            if icon_id is None:
+                icon_id = self.icons[key] = next_id
+                self.icons.setdefault(icon_key(record['url_ico'], None), icon_id)
+                next_id += 1
+                favicons.append({'id': icon_id, 'url': record['url_ico'], 'icon_type': record['type']})
+                favicon_bitmaps.append({
+                    'icon_id': icon_id,
+                    'last_updated': utils.date_from_webkit(utils.convert_timestamp_from_iso(record['last_updated'])),
+                    'image_data': image_data,
+                    'width': record.get('width', 0),
+                    'height': record.get('height', 0),
+                    'last_requested': 0})
+            icon_mappings.append({'page_url': record['url'], 'icon_id': icon_id})
+
+        db.insert_many(Favicons, favicons)
+        db.insert_many(FaviconBitmaps, favicon_bitmaps)
+        db.insert_many(IconMapping, icon_mappings)
+
+    def load_icons(self, urls):
+        """
+        Load the existing icons of urls, only reading the bitmaps of those icons.
+        """
+        for batch in chunked(sorted(urls), URL_BATCH_SIZE):
+            query = (Favicons.select(Favicons.id, Favicons.url, FaviconBitmaps.image_data)
+                     .join(FaviconBitmaps, JOIN.LEFT_OUTER, on=(FaviconBitmaps.icon_id == Favicons.id))
+                     .where(Favicons.url.in_(batch)))
+            for icon_id, url, image_data in query.tuples():
+                self.icons.setdefault(icon_key(url, None), icon_id)
+                if image_data:
+                    self.icons.setdefault(icon_key(url, image_data), icon_id)
+        self.loaded_urls.update(urls)
 
-    def update_chrome_favicon(self):
-        last_updated = utils.date_from_webkit(utils.convert_timestamp_from_iso(self.data['last_updated']))
-        with db.open_chrome_favicon(self.filename):
-            favicon = Favicons(url=self.data['url_ico'], type=self.data['type'])
-            favicon.save(force_insert=True)
+    @staticmethod
+    @functools.lru_cache(maxsize=64)
+    def load_image(image):
+        with open(pathlib.Path("examples") / image, 'rb') as f:
+            return f.read()
 
-            icon_mapping = IconMapping(page_url=self.data['url'], icon_id=favicon.id)
-            icon_mapping.save(force_insert=True)
 
-            favicon_bitmaps = FaviconBitmaps(icon_id=favicon.id, last_updated=last_updated, image_data=None, width=0, height=0, last_requested=0)
-            favicon_bitmaps.save(force_insert=True)
+def icon_key(url, image_data):
+    if image_data:
+        return url, hashlib.sha1(image_data).digest()
+    return url
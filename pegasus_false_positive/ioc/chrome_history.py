@@ -1,23 +1,27 @@
 import logging
 from urllib.parse import urlparse
 
+import peewee
+
 from pegasus_false_positive import db
 from pegasus_false_positive.db import Files, Urls
 from pegasus_false_positive.ioc.baseioc import BaseIOC
 from pegasus_false_positive.utils import utils
 
 RELATIVE_PATH = "Library/Application Support/Google/Chrome/Default/History"
+LAST_VISIT_UPDATE = 'UPDATE urls SET last_visit_time = MAX(last_visit_time, ?) WHERE id = ?'
 logger = logging.getLogger('pegasus-false-positive')
 
 
 class ChromeHistory(BaseIOC):
-    def __init__(self, backup_path, file_locator, config_file):
-        super().__init__(backup_path, file_locator)
+    REQUIRED_FIELDS = ('domain', 'last_visit_time')
+
+    def __init__(self, backup_path, file_locator, config_file, in_memory=False):
+        super().__init__(backup_path, file_locator, in_memory=in_memory)
         self.init = True
         try:
-            self.data = super().params_file_to_dict(config_file)
-            self.filename = super().get_file_name(RELATIVE_PATH)
-            self.attrs = Files.get_file_attributes_by_relative_path(RELATIVE_PATH)
+            super().load_records(config_file)
+            super().load_manifest_record(RELATIVE_PATH)
         except Files.DoesNotExist:
             logger.info("No Chrome")
             self.init = False
@@ -28,20 +32,41 @@ class ChromeHistory(BaseIOC):
     def run(self):
         try:
             self.decrypt_if_needed()
-            self.update_chrome_history()
-            self.crypt_if_needed()
-            logger.info('Suspicious %s domain inserted in chrome history', self.data['domain'])
+            self.insert_records()
+            digest, size = self.crypt_if_needed()
+            super().update_manifest_file(size, digest)
+            for record in self.records:
+                logger.info('Suspicious %s domain inserted in chrome history', record['domain'])
         except Exception as er:
-            logger.error("Inserting Chrome URL %s: %s", self.data['domain'], er)
-
-    def update_chrome_history(self):
-        last_visit_time = utils.date_from_webkit(utils.convert_timestamp_from_iso(self.data['last_visit_time']))
-        with db.open_chrome(self.filename):
-            url = Urls.get_last()
-            domain = urlparse(self.data['domain']).netloc
-
-            url.id = None
-            url.title = domain
-            url.url = self.data['domain']
-            url.last_visit_time = last_visit_time
-            url.save(force_insert=True)
+            logger.error("Inserting Chrome URLs of %s: %s", self.config_file, er)
+
+    def insert_records(self):
+        """
+        Insert a urls row per new URL, keeping the latest visit of each. URLs already in the history only get their
+        last_visit_time moved forward.
+        """
+        last_visits = {}
+        for record in self.records:
+            last_visit_time = utils.date_from_webkit(utils.convert_timestamp_from_iso(record['last_visit_time']))
+            last_visits[record['domain']] = max(last_visit_time, last_visits.get(record['domain'], last_visit_time))
+
+        with db.open_chrome(self.database) as chrome_db:
+            template = Urls.get_last()
+            with chrome_db.atomic():
+                updates = []
+                for batch in peewee.chunked(list(last_visits), db.max_variables(Urls)):
+                    for url_id, url in Urls.select(Urls.id, Urls.url).where(Urls.url.in_(batch)).tuples():
+                        if url in last_visits:
+                            updates.append((last_visits.pop(url), url_id))
+                chrome_db.connection().executemany(LAST_VISIT_UPDATE, updates)
+
+                urls = []
+                for url, last_visit_time in last_visits.items():
+                    urls.append({
+                        'url': url,
+                        'title': urlparse(url).netloc,
+                        'visit_count': template.visit_count,
+                        'typed_count': template.typed_count,
+                        'last_visit_time': last_visit_time,
+                        'hidden': template.hidden})
+                db.insert_many(Urls, urls)
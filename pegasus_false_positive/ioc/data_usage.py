@@ -1,23 +1,38 @@
 import logging
-import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from pegasus_false_positive import db
-from pegasus_false_positive.db import Files, ZProcess, ZLiveUsage
+from pegasus_false_positive.db import Files, ZProcess
 from pegasus_false_positive.ioc.baseioc import BaseIOC
 from pegasus_false_positive.utils import utils
 
 RELATIVE_PATH = 'Library/Databases/DataUsage.sqlite'
+MAC_EPOCH = 978307200
+DEFAULT_INTERVAL = 60 * 60
+DEFAULT_SIGMA = 1.0
+COUNTERS = ('wifi_in', 'wifi_out', 'wwan_in', 'wwan_out')
+PROCESS_TIMESTAMPS_UPDATE = ('UPDATE ZPROCESS SET ZFIRSTTIMESTAMP = MIN(IFNULL(ZFIRSTTIMESTAMP, ?1), ?1), '
+                             'ZTIMESTAMP = MAX(IFNULL(ZTIMESTAMP, ?2), ?2) WHERE Z_PK = ?3')
+LIVE_USAGE_INSERT = ('INSERT INTO ZLIVEUSAGE (Z_ENT, Z_OPT, ZKIND, ZMETADATA, ZTAG, ZBILLCYCLEEND, ZHASPROCESS, '
+                     'ZTIMESTAMP, ZWIFIIN, ZWIFIOUT, ZWWANIN, ZWWANOUT) VALUES (5, 3, 0, 0, 1, NULL, ?, ?, ?, ?, ?, ?)')
 logger = logging.getLogger('pegasus-false-positive')
 
 
 class DataUsage(BaseIOC):
-    def __init__(self, backup_path, file_locator, config_file):
-        super().__init__(backup_path, file_locator)
+    REQUIRED_FIELDS = ('bundle', 'process', 'time', 'wifi_in', 'wifi_out', 'wwan_in', 'wwan_out')
+
+    def __init__(self, backup_path, file_locator, config_file, in_memory=False):
+        super().__init__(backup_path, file_locator, in_memory=in_memory)
         self.init = True
+        # Z_PK of the processes by bundle and process name, loaded on the first insert and kept between chunks
+        self.processes = None
         try:
-            self.data = super().params_file_to_dict(config_file)
-            self.filename = super().get_file_name(RELATIVE_PATH)
-            self.attrs = Files.get_file_attributes_by_relative_path(RELATIVE_PATH)
+            super().load_records(config_file)
+            super().load_manifest_record(RELATIVE_PATH)
         except Files.DoesNotExist:
             logger.info("No data usage")
             self.init = False
@@ -28,42 +43,105 @@ class DataUsage(BaseIOC):
     def run(self):
         try:
             self.decrypt_if_needed()
-            self.update_data_usage()
-            size = os.path.getsize(self.filename)
-            self.crypt_if_needed()
-            super().update_manifest_file(RELATIVE_PATH, self.filename, size)
-            logger.info('Suspicious %s Data_usage process inserted', self.data['process'])
+            self.insert_records()
+            digest, size = self.crypt_if_needed()
+            super().update_manifest_file(size, digest)
+            for record in self.records:
+                logger.info('Suspicious %s Data_usage process inserted', record['process'])
         except Exception as er:
-            logger.error("Inserting Data_usage process %s: %s", self.data['process'], er)
-
-    def update_data_usage(self):
-        with db.open_data_usage(self.filename):
-            timestamp = utils.convert_timestamp_to_mac(utils.convert_timestamp_from_iso(self.data['time']))
-            zprocess = ZProcess.get_or_none(ZBUNDLENAME=self.data['bundle'], ZPROCNAME=self.data['process'])
-            if zprocess is not None:
-                zprocess.update(ZTIMESTAMP=timestamp).where(ZProcess.ZTIMESTAMP < timestamp).execute()
-                zprocess.update(ZFIRSTTIMESTAMP=timestamp).where(ZProcess.ZFIRSTTIMESTAMP > timestamp).execute()
+            logger.error("Inserting Data_usage processes of %s: %s", self.config_file, er)
+
+    def insert_records(self):
+        with db.open_data_usage(self.database) as data_usage_db:
+            with data_usage_db.atomic():
+                self.insert_usages(data_usage_db)
+                ZProcess.delete().where(ZProcess.ZBUNDLENAME == "", ZProcess.ZPROCNAME == "").execute()
+
+    def insert_usages(self, data_usage_db):
+        """
+        Insert a ZLIVEUSAGE sample per record, or a generated series for records with "samples", and keep the first
+        and last timestamps of their processes up to date.
+        """
+        if self.processes is None:
+            query = ZProcess.select(ZProcess.ZBUNDLENAME, ZProcess.ZPROCNAME, ZProcess.Z_PK)
+            self.processes = {(bundle, process): pk for bundle, process, pk in query.tuples()}
+
+        # Timestamps and counters of every process, as lists or NumPy arrays
+        usages = {}
+        for record in self.records:
+            key = (record['bundle'], record['process'])
+            if 'samples' in record:
+                if numpy is None:
+                    logger.error("NumPy is needed to generate the data usage series of %s", record['process'])
+                    continue
+                if not valid_samples(record['samples']):
+                    logger.error("Data usage series of %s needs at least one sample", record['process'])
+                    continue
+                timestamps, counters = generate_series(record)
             else:
+                timestamp = utils.convert_timestamp_to_mac(utils.convert_timestamp_from_iso(record['time']))
+                timestamps, counters = [timestamp], [[float(record[counter])] for counter in COUNTERS]
+            usages.setdefault(key, []).append((timestamps, counters))
+
+        rows = []
+        first_last = []
+        for key, series in usages.items():
+            # Timestamps of a series are ascending
+            first = min(timestamps[0] for timestamps, _ in series)
+            last = max(timestamps[-1] for timestamps, _ in series)
+            process_pk = self.processes.get(key)
+            if process_pk is None:
                 zprocess = ZProcess(Z_ENT=7,
                                     Z_OPT=3,
-                                    ZFIRSTTIMESTAMP=timestamp,
-                                    ZTIMESTAMP=timestamp,
-                                    ZBUNDLENAME=self.data['bundle'],
-                                    ZPROCNAME=self.data['process'])
+                                    ZFIRSTTIMESTAMP=first,
+                                    ZTIMESTAMP=last,
+                                    ZBUNDLENAME=key[0],
+                                    ZPROCNAME=key[1])
                 zprocess.save(force_insert=True)
+                process_pk = self.processes[key] = zprocess.Z_PK
+            else:
+                first_last.append((round(first), round(last), process_pk))
 
-            z_live_usage = ZLiveUsage(Z_ENT=5,
-                                    Z_OPT=3,
-                                    ZKIND=0,
-                                    ZMETADATA=0,
-                                    ZTAG=1,
-                                    ZHASPROCESS=zprocess.Z_PK,
-                                    ZBILLCYCLEEND=None,
-                                    ZTIMESTAMP=timestamp,
-                                    ZWIFIIN=self.data['wifi_in'],
-                                    ZWIFIOUT=self.data['wifi_out'],
-                                    ZWWANIN=self.data['wwan_in'],
-                                    ZWWANOUT=self.data['wwan_out'])
-            z_live_usage.save(force_insert=True)
-
-            ZProcess.delete().where(ZProcess.ZBUNDLENAME=="", ZProcess.ZPROCNAME=="").execute()
+            for timestamps, counters in series:
+                if numpy is not None and isinstance(timestamps, numpy.ndarray):
+                    timestamps = timestamps.round().astype(numpy.int64).tolist()
+                    counters = [values.tolist() for values in counters]
+                else:
+                    timestamps = [round(timestamp) for timestamp in timestamps]
+                rows.extend((process_pk, timestamp, *values) for timestamp, *values in zip(timestamps, *counters))
+
+        connection = data_usage_db.connection()
+        connection.executemany(PROCESS_TIMESTAMPS_UPDATE, first_last)
+        connection.executemany(LIVE_USAGE_INSERT, rows)
+
+
+def valid_samples(samples):
+    try:
+        return int(samples) >= 1
+    except (TypeError, ValueError):
+        return False
+
+
+def generate_series(record):
+    """
+    Samples every record["interval"] seconds, hourly by default, ending at record["time"]. Counters are drawn from a
+    lognormal distribution of shape record["sigma"] whose mean is the record counter. Returns Mac absolute timestamps
+    and the counters as NumPy arrays.
+    """
+    samples = int(record['samples'])
+    interval = record.get('interval', DEFAULT_INTERVAL)
+    sigma = record.get('sigma', DEFAULT_SIGMA)
+    random = numpy.random.default_rng(record.get('seed'))
+
+    end = utils.convert_timestamp_to_unix(utils.convert_timestamp_from_iso(record['time']))
+    unix_timestamps = end - interval * numpy.arange(samples - 1, -1, -1, dtype=numpy.float64)
+    timestamps = unix_timestamps - MAC_EPOCH
+
+    counters = []
+    for counter in COUNTERS:
+        mean = float(record[counter])
+        if mean > 0:
+            counters.append(random.lognormal(numpy.log(mean) - sigma ** 2 / 2, sigma, samples).round())
+        else:
+            counters.append(numpy.zeros(samples))
+    return timestamps, counters
@@ -1,11 +1,10 @@
 import logging
-import os
 import pathlib
 import plistlib
-import shutil
 import struct
 from datetime import datetime
 
+from pegasus_false_positive import db
 from pegasus_false_positive.db import Files
 from pegasus_false_positive.ioc.baseioc import BaseIOC
 from pegasus_false_positive.utils import fileutils
@@ -16,6 +15,8 @@ logger = logging.getLogger('pegasus-false-positive')
 
 
 class File(BaseIOC):
+    IN_MEMORY = False
+
     def __init__(self, backup_path, file_locator, config_file):
         super().__init__(backup_path, file_locator)
         self.init = True
@@ -23,8 +24,14 @@ class File(BaseIOC):
             self.init = False
             logger.info("File is not inserted. Backup is not encrypted")
             return
+        self.files = []
         try:
-            self.data = super().params_file_to_dict(config_file)
+            super().load_records(config_file)
+            for record in self.records:
+                file_id = fileutils.get_file_id(record['domain'], record['path'])
+                filename = fileutils.get_file_path_from_id(self.backup_path, file_id)
+                self.get_or_create_manifest_attributes(file_id, record['domain'], record['path'])
+                self.files.append((self.record, filename, record['file']))
         except Files.DoesNotExist:
             logger.info("No File")
             self.init = False
@@ -33,25 +40,23 @@ class File(BaseIOC):
             self.init = False
 
     def run(self):
-        try:
-            self.upload_file(pathlib.Path("examples") / self.data['file'])
-            size = os.path.getsize(self.filename)
-            super().update_manifest_file(self.data['path'], self.filename, size)
-            logger.info('Suspicious File %s inserted', self.data['file'])
-        except Exception as er:
-            logger.error("Inserting File %s: %s", self.data['file'], er)
+        for record, filename, source in self.files:
+            self.record, self.filename, self.attrs = record, filename, record.attrs
+            try:
+                digest, size = self.upload_file(pathlib.Path("examples") / source)
+                super().update_manifest_file(size, digest)
+                logger.info('Suspicious File %s inserted', source)
+            except Exception as er:
+                logger.error("Inserting File %s: %s", source, er)
 
     def upload_file(self, file):
-        file_id = fileutils.get_file_id(self.data['domain'], self.data['path'])
-        self.filename = fileutils.get_file_path_from_id(self.backup_path, file_id)
         self.filename.parent.mkdir(exist_ok=True)
-        self.get_or_create_manifest_attributes(file_id, self.data['domain'], self.data['path'])
-        shutil.copy(file, self.filename)
-        self.file_locator.encrypt_file(self.filename, self.attrs)
+        return self.file_locator.copy_file(file, self.filename, self.attrs)
 
     def get_or_create_manifest_attributes(self, file_id, domain, path):
-        attrs = Files.get_file_attributes_by_file_id(file_id)
-        if not attrs:
+        catalog = db.get_manifest_catalog()
+        self.record = catalog.get_by_file_id(file_id)
+        if self.record is None:
             now = convert_timestamp_to_unix(datetime.now())
             file_data = {
                 '$class': None,
@@ -83,11 +88,9 @@ class File(BaseIOC):
             })
             attrs['$top'] = {'root': plistlib.UID(1)}
             attrs['$version'] = 100000
-            file_metadata = Files(fileID=file_id, domain=domain, relativePath=path, flags=1,
-                                  file=plistlib.dumps(attrs, fmt=plistlib.FMT_BINARY))
-            file_metadata.save(force_insert=True)
+            self.record = catalog.add(file_id, domain, path, 1, attrs)
 
-        self.attrs = attrs
+        self.attrs = self.record.attrs
 
     def _create_extra_attributes(self, file_data):
         file_data['EncryptionKey'] = plistlib.UID(4)
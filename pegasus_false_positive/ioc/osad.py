@@ -1,25 +1,24 @@
 import logging
-import os
-import plistlib
 from urllib.parse import urlparse
 
 from pegasus_false_positive import db
 from pegasus_false_positive.db import Files
-from pegasus_false_positive.ioc.baseioc import BaseIOC
+from pegasus_false_positive.ioc.baseioc import PlistIOC
 from pegasus_false_positive.utils import utils
 
 RELATIVE_PATH = 'Library/Preferences/com.apple.osanalytics.addaily.plist'
 logger = logging.getLogger('pegasus-false-positive')
 
 
-class Osad(BaseIOC):
+class Osad(PlistIOC):
+    REQUIRED_FIELDS = ('app', 'time', 'wifi_in', 'wifi_out', 'wwan_in', 'wwan_out')
+
     def __init__(self, backup_path, file_locator, config_file):
         super().__init__(backup_path, file_locator)
-        self.init = False
+        self.init = True
         try:
-            self.data = super().params_file_to_dict(config_file)
-            self.filename = super().get_file_name(RELATIVE_PATH)
-            self.attrs = Files.get_file_attributes_by_relative_path(RELATIVE_PATH)
+            super().load_records(config_file)
+            super().load_manifest_record(RELATIVE_PATH)
         except Files.DoesNotExist:
             logger.info("No Osad")
             self.init = False
@@ -30,22 +29,20 @@ class Osad(BaseIOC):
     def run(self):
         try:
             self.decrypt_if_needed()
-            self.update_osad()
-            size = os.path.getsize(self.filename)
-            self.crypt_if_needed()
-            super().update_manifest_file(RELATIVE_PATH, self.filename, size)
-            logger.info('Suspicious Os Analytics of %s data inserted', self.data['app'])
+            self.insert_records()
+            self.save_plist()
+            digest, size = self.crypt_if_needed()
+            super().update_manifest_file(size, digest)
+            for record in self.records:
+                logger.info('Suspicious Os Analytics of %s data inserted', record['app'])
         except Exception as er:
-            logger.info("Modifying Os Analytics %s: %s", self.data['app'], er)
-
-    def update_osad(self):
-        with open(self.filename, "rb") as f:
-            plist_data = plistlib.load(f, fmt=plistlib.FMT_BINARY)
-
-        plist_data['netUsageBaseline'][self.data['app']] = [utils.convert_timestamp_from_iso(self.data['time']),
-                                                            float(self.data['wifi_in']), float(self.data['wifi_out']),
-                                                            float(self.data['wwan_in']),
-                                                            float(self.data['wwan_out'])]
-
-        with open(self.filename, "wb") as f:
-            f.write(plistlib.dumps(plist_data, fmt=plistlib.FMT_BINARY))
+            logger.error("Modifying Os Analytics of %s: %s", self.config_file, er)
+
+    def insert_records(self):
+        baselines = {}
+        for record in self.records:
+            baselines[record['app']] = [utils.convert_timestamp_from_iso(record['time']),
+                                        float(record['wifi_in']), float(record['wifi_out']),
+                                        float(record['wwan_in']),
+                                        float(record['wwan_out'])]
+        self.load_plist().setdefault('netUsageBaseline', {}).update(baselines)
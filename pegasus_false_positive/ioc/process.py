@@ -1,22 +1,25 @@
+import copy
 import logging
-import os
-import plistlib
 
 from pegasus_false_positive.db import Files
-from pegasus_false_positive.ioc.baseioc import BaseIOC
+from pegasus_false_positive.ioc.baseioc import PlistIOC
 
 RELATIVE_PATH = "Library/Caches/locationd/clients.plist"
+TEMPLATE_CLIENT = 'com.apple.weather'
 logger = logging.getLogger('pegasus-false-positive')
 
 
-class Process(BaseIOC):
+class Process(PlistIOC):
+    REQUIRED_FIELDS = ('bundle',)
+
     def __init__(self, backup_path, file_locator, config_file):
         super().__init__(backup_path, file_locator)
         self.init = True
+        # Copy of the com.apple.weather client every new client is stamped from
+        self.client_template = None
         try:
-            self.data = super().params_file_to_dict(config_file)
-            self.filename = super().get_file_name(RELATIVE_PATH)
-            self.attrs = Files.get_file_attributes_by_relative_path(RELATIVE_PATH)
+            super().load_records(config_file)
+            super().load_manifest_record(RELATIVE_PATH)
         except Files.DoesNotExist:
             logger.info("No Process")
             self.init = False
@@ -27,19 +30,24 @@ class Process(BaseIOC):
     def run(self):
         try:
             self.decrypt_if_needed()
-            self.parse_plist()
-            size = os.path.getsize(self.filename)
-            self.crypt_if_needed()
-            super().update_manifest_file(RELATIVE_PATH, self.filename, size)
-            logger.info('Suspicious Process %s data inserted', self.data['bundle'])
+            self.insert_records()
+            self.save_plist()
+            digest, size = self.crypt_if_needed()
+            super().update_manifest_file(size, digest)
+            for record in self.records:
+                logger.info('Suspicious Process %s data inserted', record['bundle'])
         except Exception as er:
-            logger.error("Inserting Process %s: %s", self.data['bundle'], er)
-
-    def parse_plist(self):
-        with open(self.filename, "rb") as f:
-            plist_data = plistlib.load(f, fmt=plistlib.FMT_BINARY)
-
-        plist_data[self.data['bundle']] = plist_data['com.apple.weather']
-
-        with open(self.filename, "wb") as f:
-            f.write(plistlib.dumps(plist_data, fmt=plistlib.FMT_BINARY))
+            logger.error("Inserting Processes of %s: %s", self.config_file, er)
+
+    def insert_records(self):
+        plist_data = self.load_plist()
+        if self.client_template is None:
+            self.client_template = copy.deepcopy(plist_data[TEMPLATE_CLIENT])
+
+        clients = {}
+        for record in self.records:
+            client = copy.deepcopy(self.client_template)
+            if 'BundleId' in client:
+                client['BundleId'] = record['bundle']
+            clients[record['bundle']] = client
+        plist_data.update(clients)
@@ -1,25 +1,31 @@
 import json
 import logging
-import os
+import struct
 from urllib.parse import urlparse
 
+import peewee
+from peewee import EXCLUDED
+
 from pegasus_false_positive import db
 from pegasus_false_positive.db import Files, HistoryItems, HistoryVisits
 from pegasus_false_positive.ioc.baseioc import BaseIOC
 from pegasus_false_positive.utils import utils
 
 RELATIVE_PATH = 'Library/Safari/History.db'
+SECONDS_PER_DAY = 24 * 60 * 60
+DAILY_VISIT_COUNTS_UPDATE = 'UPDATE history_items SET daily_visit_counts = ? WHERE id = ?'
 logger = logging.getLogger('pegasus-false-positive')
 
 
 class SafariHistory(BaseIOC):
-    def __init__(self, backup_path, file_locator, config_file):
-        super().__init__(backup_path, file_locator)
+    REQUIRED_FIELDS = ('title', 'url', 'domain', 'time', 'score')
+
+    def __init__(self, backup_path, file_locator, config_file, in_memory=False):
+        super().__init__(backup_path, file_locator, in_memory=in_memory)
         self.init = True
         try:
-            self.data = super().params_file_to_dict(config_file)
-            self.filename = super().get_file_name(RELATIVE_PATH)
-            self.attrs = Files.get_file_attributes_by_relative_path(RELATIVE_PATH)
+            super().load_records(config_file)
+            super().load_manifest_record(RELATIVE_PATH)
         except Files.DoesNotExist:
             logger.info("No Safari")
             self.init = False
@@ -30,40 +36,93 @@ class SafariHistory(BaseIOC):
     def run(self):
         try:
             self.decrypt_if_needed()
-            self.update_safari_history()
-            size = os.path.getsize(self.filename)
-            self.crypt_if_needed()
-            super().update_manifest_file(RELATIVE_PATH, self.filename, size)
-            logger.info('Suspicious %s domain inserted in Safari history', self.data['domain'])
+            self.insert_records()
+            digest, size = self.crypt_if_needed()
+            super().update_manifest_file(size, digest)
+            for record in self.records:
+                logger.info('Suspicious %s domain inserted in Safari history', record['domain'])
         except Exception as er:
-            logger.error("Inserting Safari URL %s: %s", self.data['url'], er)
-
-    def update_safari_history(self):
-        timestamp = utils.convert_timestamp_to_mac(utils.convert_timestamp_from_iso(self.data['time']))
-        with db.open_safari(self.filename):
-            history_item = HistoryItems(
-                url=self.data['url'],
-                domain_expansion=self.data['domain'],
-                visit_count=1,
-                daily_visit_counts='d',
-                weekly_visit_counts=None,
-                autocomplete_triggers=None,
-                should_recompute_derived_visit_counts=0,
-                visit_count_score=self.data['score'],
-                status_code=302)
-            history_item.save(force_insert=True)
-
-            history_visit = HistoryVisits(
-                visit_time=timestamp,
-                title=self.data['title'],
-                load_successful=1,
-                history_item=history_item.id,
-                http_non_get=0,
-                synthesized=0,
-                redirect_source=None,
-                redirect_destination=None,
-                origin=0,
-                generation=0,
-                attributes=0,
-                score=self.data['score'])
-            history_visit.save()
+            logger.error("Inserting Safari URLs of %s: %s", self.config_file, er)
+
+    def insert_records(self):
+        """
+        Insert every visit, grouped by URL so each history_items row is upserted once with its accumulated visit count.
+        """
+        visits_by_url = {}
+        for record in self.records:
+            timestamp = utils.convert_timestamp_to_mac(utils.convert_timestamp_from_iso(record['time']))
+            visits_by_url.setdefault(record['url'], []).append((timestamp, record))
+        if not visits_by_url:
+            return
+
+        with db.open_safari(self.database) as safari_db:
+            with safari_db.atomic():
+                history_items = []
+                for url, visits in visits_by_url.items():
+                    last_timestamp, last_record = max(visits, key=lambda visit: visit[0])
+                    history_items.append({
+                        'url': url,
+                        'domain_expansion': last_record['domain'],
+                        'visit_count': len(visits),
+                        'daily_visit_counts': daily_visit_counts([timestamp for timestamp, _ in visits]),
+                        'weekly_visit_counts': None,
+                        'autocomplete_triggers': None,
+                        'should_recompute_derived_visit_counts': 0,
+                        'visit_count_score': last_record['score']})
+
+                db.insert_many(HistoryItems, history_items, conflict_target=[HistoryItems.url],
+                               update={HistoryItems.visit_count: HistoryItems.visit_count + EXCLUDED.visit_count,
+                                       HistoryItems.visit_count_score: EXCLUDED.visit_count_score})
+
+                item_ids = {}
+                for batch in peewee.chunked(list(visits_by_url), db.max_variables(HistoryItems)):
+                    query = HistoryItems.select(HistoryItems.id, HistoryItems.url).where(HistoryItems.url.in_(batch))
+                    item_ids.update((url, item_id) for item_id, url in query.tuples())
+
+                history_visits = []
+                for url, visits in visits_by_url.items():
+                    for timestamp, record in visits:
+                        history_visits.append({
+                            'visit_time': timestamp,
+                            'title': record['title'],
+                            'load_successful': 1,
+                            'history_item': item_ids[url],
+                            'http_non_get': 0,
+                            'synthesized': 0,
+                            'redirect_source': None,
+                            'redirect_destination': None,
+                            'origin': 0,
+                            'generation': 0,
+                            'attributes': 0,
+                            'score': record['score']})
+                db.insert_many(HistoryVisits, history_visits)
+
+                self.update_daily_visit_counts(safari_db, list(item_ids.values()))
+
+    @staticmethod
+    def update_daily_visit_counts(safari_db, item_ids):
+        """
+        Recompute daily_visit_counts from every visit of the given items, so URLs already in the history or repeated
+        across chunks stay consistent with history_visits.
+        """
+        visit_times = {}
+        for batch in peewee.chunked(item_ids, db.max_variables(HistoryVisits)):
+            query = (HistoryVisits.select(HistoryVisits.history_item, HistoryVisits.visit_time)
+                     .where(HistoryVisits.history_item.in_(batch)))
+            for item_id, visit_time in query.tuples():
+                visit_times.setdefault(item_id, []).append(visit_time)
+
+        rows = [(daily_visit_counts(times), item_id) for item_id, times in visit_times.items()]
+        safari_db.connection().executemany(DAILY_VISIT_COUNTS_UPDATE, rows)
+
+
+def daily_visit_counts(visit_times):
+    """
+    Visits per day as little endian int32 counters, the first one for the day of the last visit.
+    """
+    days = [int(visit_time // SECONDS_PER_DAY) for visit_time in visit_times]
+    last_day = max(days)
+    counts = [0] * (last_day - min(days) + 1)
+    for day in days:
+        counts[last_day - day] += 1
+    return struct.pack('<%di' % len(counts), *counts)
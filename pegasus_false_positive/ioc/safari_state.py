@@ -1,5 +1,5 @@
+import bisect
 import logging
-import os
 import plistlib
 import uuid
 
@@ -9,17 +9,35 @@ from pegasus_false_positive.ioc.baseioc import BaseIOC
 from pegasus_false_positive.utils import utils
 
 RELATIVE_PATH = 'Library/Safari/BrowserState.db'
+ORDER_INDEX_UPDATE = 'UPDATE tabs SET order_index = ? WHERE id = ?'
 logger = logging.getLogger('pegasus-false-positive')
 
 
+def insert_order(previous_indexes, new_indexes):
+    """
+    Insert in turn every (key, order_index) of new_indexes among the tabs of previous_indexes, a dict of key: order_index,
+    moving up by one the tabs at or after each insertion point. Returns the final order_index of every key.
+    """
+    # Keys and their indexes, sorted by index
+    order = sorted(previous_indexes, key=previous_indexes.get)
+    indexes = [previous_indexes[key] for key in order]
+    for key, order_index in new_indexes:
+        position = bisect.bisect_left(indexes, order_index)
+        indexes[position:] = [index + 1 for index in indexes[position:]]
+        order.insert(position, key)
+        indexes.insert(position, order_index)
+    return dict(zip(order, indexes))
+
+
 class SafariState(BaseIOC):
-    def __init__(self, backup_path, file_locator, config_file):
-        super().__init__(backup_path, file_locator)
+    REQUIRED_FIELDS = ('title', 'url', 'user_visible_url', 'order_index', 'last_viewed_time')
+
+    def __init__(self, backup_path, file_locator, config_file, in_memory=False):
+        super().__init__(backup_path, file_locator, in_memory=in_memory)
         self.init = True
         try:
-            self.data = super().params_file_to_dict(config_file)
-            self.filename = super().get_file_name(RELATIVE_PATH)
-            self.attrs = Files.get_file_attributes_by_relative_path(RELATIVE_PATH)
+            super().load_records(config_file)
+            super().load_manifest_record(RELATIVE_PATH)
         except Files.DoesNotExist:
             logger.info("No Safari State")
             self.init = False
@@ -30,58 +48,82 @@ class SafariState(BaseIOC):
     def run(self):
         try:
             self.decrypt_if_needed()
-            self.update_safari_state()
-            size = os.path.getsize(self.filename)
-            self.crypt_if_needed()
-            super().update_manifest_file(RELATIVE_PATH, self.filename, size)
+            self.insert_records()
+            digest, size = self.crypt_if_needed()
+            super().update_manifest_file(size, digest)
         except Exception as er:
-            logger.error("Inserting Safari URL %s in Safari State: %s", self.data['url'], er)
+            logger.error("Inserting Safari URLs of %s in Safari State: %s", self.config_file, er)
 
-    def update_safari_state(self):
-        last_viewed_time = utils.convert_timestamp_to_mac(
-            utils.convert_timestamp_from_iso(self.data['last_viewed_time']))
-        with db.open_safari_state(self.filename):
+    def insert_records(self):
+        with db.open_safari_state(self.database) as safari_state_db:
             browser_window = BrowserWindows.get_last()
             if browser_window is None:
                 logger.info("No tab")
                 return
-            order_index = self.data["order_index"]
-            Tabs.update_order_index(order_index)
-
-            tab_uuid = str(uuid.uuid4())
-
-            tab = Tabs(
-                uuid=tab_uuid,
-                title=self.data["title"],
-                url=self.data["url"],
-                user_visible_url=self.data["user_visible_url"],
-                order_index=order_index,
-                last_viewed_time=last_viewed_time,
-                browser_window_uuid=browser_window.uuid,
-                browser_window_id=browser_window.id
-            )
-            tab.save(force_insert=True)
-
-            session_data = self.create_plist()
-            data_size = len(session_data)
-
-            tab_session = TabSession (
-                tab_uuid=tab_uuid,
-                uncompressed_session_data_size=data_size,
-                session_data=session_data
-            )
-
-            tab_session.save(force_insert=True)
-
-            logger.info('Suspicious %s domain inserted in Safari state', self.data['url'])
 
-    def create_plist(self):
+            with safari_state_db.atomic():
+                self.insert_tabs(safari_state_db, browser_window)
+
+            for record in self.records:
+                logger.info('Suspicious %s domain inserted in Safari state', record['url'])
+
+    def insert_tabs(self, safari_state_db, browser_window):
+        """
+        Insert a tab per record at its order_index in the window, moving up by one the tabs at or after it. The final
+        order is computed in memory, so the tabs already in the window are reindexed with a single executemany.
+        """
+        existing = (Tabs.select(Tabs.id, Tabs.order_index)
+                    .where(Tabs.browser_window_id == browser_window.id)
+                    .order_by(Tabs.order_index, Tabs.id))
+        previous_indexes = dict(existing.tuples())
+
+        new_tabs = []
+        for record in self.records:
+            tab = {
+                'uuid': str(uuid.uuid4()),
+                'title': record["title"],
+                'url': record["url"],
+                'user_visible_url': record["user_visible_url"],
+                'last_viewed_time': utils.convert_timestamp_to_mac(
+                    utils.convert_timestamp_from_iso(record['last_viewed_time'])),
+                'browser_window_uuid': browser_window.uuid,
+                'browser_window_id': browser_window.id
+            }
+            new_tabs.append((tab, record))
+
+        final_indexes = insert_order(previous_indexes,
+                                     [(tab['uuid'], record["order_index"]) for tab, record in new_tabs])
+        reindex = [(final_indexes[tab_id], tab_id) for tab_id, order_index in previous_indexes.items()
+                   if final_indexes[tab_id] != order_index]
+        safari_state_db.connection().executemany(ORDER_INDEX_UPDATE, reindex)
+
+        tabs = []
+        tab_sessions = []
+        session_data_cache = {}
+        for tab, record in new_tabs:
+            tab['order_index'] = final_indexes[tab['uuid']]
+            tabs.append(tab)
+
+            session_key = (record["url"], record["title"], record["user_visible_url"])
+            session_data = session_data_cache.get(session_key)
+            if session_data is None:
+                session_data = session_data_cache[session_key] = self.create_plist(record)
+            tab_sessions.append({
+                'tab_uuid': tab['uuid'],
+                'uncompressed_session_data_size': len(session_data),
+                'session_data': session_data
+            })
+
+        db.insert_many(Tabs, tabs)
+        db.insert_many(TabSession, tab_sessions)
+
+    def create_plist(self, record):
         plist_data = {"RenderTreeSize": 415, "IsAppInitiated": False, "SessionHistory": {}}
 
-        data_entry = {"SessionHistoryEntryData": b'', "SessionHistoryEntryTitle": self.data["title"],
+        data_entry = {"SessionHistoryEntryData": b'', "SessionHistoryEntryTitle": record["title"],
                       "SessionHistoryEntryShouldOpenExternalURLsPolicyKey": (2,),
-                      "SessionHistoryEntryURL": (self.data["url"],),
-                      "SessionHistoryEntryOriginalURL": self.data["user_visible_url"]}
+                      "SessionHistoryEntryURL": (record["url"],),
+                      "SessionHistoryEntryOriginalURL": record["user_visible_url"]}
         plist_data["SessionHistory"]["SessionHistoryEntries"] = [data_entry]
 
         plist_data["SessionHistory"]["SessionHistoryCurrentIndex"] = 0
@@ -1,27 +1,166 @@
+import functools
 import logging
-import os
 import plistlib
-import re
 import uuid
 from random import randint
 
+import peewee
+from playhouse.shortcuts import model_to_dict
+
 from pegasus_false_positive import db
 from pegasus_false_positive.db import Files, ChatHandleJoin, Message, Chat, Handle, ChatMessageJoin
 from pegasus_false_positive.ioc.baseioc import BaseIOC
-from pegasus_false_positive.utils import utils
+from pegasus_false_positive.utils import typedstream, utils
 
 RELATIVE_PATH = "Library/SMS/sms.db"
+BPLIST_TEMPLATE = "pegasus_false_positive/resources/sms-bplist-template.xml"
 logger = logging.getLogger('pegasus-false-positive')
 
+MESSAGE_PART_ATTRIBUTE = b'__kIMMessagePartAttributeName'
+DATA_DETECTED_ATTRIBUTE = b'__kIMDataDetectedAttributeName'
+LINK_ATTRIBUTE = b'__kIMLinkAttributeName'
+
+NSOBJECT = ('NSObject', 0)
+NSSTRING = ('NSString', 1)
+NSMUTABLE_STRING = ('NSMutableString', 1)
+NSMUTABLE_ATTRIBUTED_STRING = ('NSMutableAttributedString', 0)
+NSATTRIBUTED_STRING = ('NSAttributedString', 0)
+NSDICTIONARY = ('NSDictionary', 0)
+NSNUMBER = ('NSNumber', 0)
+NSVALUE = ('NSValue', 0)
+NSDATA = ('NSData', 0)
+NSURL = ('NSURL', 0)
+
+
+@functools.lru_cache(maxsize=None)
+def load_bplist_template():
+    with open(BPLIST_TEMPLATE, 'rb') as f_template:
+        return plistlib.load(f_template, fmt=plistlib.FMT_XML)
+
+
+@functools.lru_cache(maxsize=1024)
+def link_bplist(url):
+    """
+    Data detector result of a link, the value of its __kIMDataDetectedAttributeName attribute.
+    """
+    template = load_bplist_template()
+    objects = list(template['$objects'])
+    objects[6] = url
+    objects[3] = len(url)
+    return plistlib.dumps(dict(template, **{'$objects': objects}), fmt=plistlib.FMT_BINARY)
+
+
+def utf16_length(text):
+    # NSString lengths and ranges are counted in UTF-16 code units
+    return len(text.encode('utf-16-le')) // 2
+
+
+def encode_attributed_body(text, url):
+    """
+    Encode text as the NSMutableAttributedString typedstream stored in message.attributedBody, with the first
+    occurrence of url marked as a detected link.
+    """
+    bplist = link_bplist(url)
+    text_bytes = text.encode('utf-8')
+    url_bytes = url.encode('utf-8')
+    writer = typedstream.TypedStreamWriter(len(text_bytes) + len(url_bytes) + len(bplist) + 512)
+
+    writer.write_type('@')
+    writer.begin_object([NSMUTABLE_ATTRIBUTED_STRING, NSATTRIBUTED_STRING, NSOBJECT])
+    writer.write_type('@')
+    _write_string(writer, [NSMUTABLE_STRING, NSSTRING, NSOBJECT], text_bytes)
+
+    start = text.find(url) if url else -1
+    if start < 0:
+        runs = [(False, utf16_length(text))]
+    else:
+        link_start = utf16_length(text[:start])
+        link_length = utf16_length(url)
+        runs = [(False, link_start), (True, link_length),
+                (False, utf16_length(text) - link_start - link_length)]
+
+    attributes = {}
+    for link, length in runs:
+        if length == 0:
+            continue
+        index = attributes.get(link)
+        writer.write_type('iI')
+        if index is not None:
+            writer.write_int(index)
+            writer.write_int(length)
+            continue
+        index = attributes[link] = len(attributes) + 1
+        writer.write_int(index)
+        writer.write_int(length)
+        writer.write_type('@')
+        _write_attributes(writer, link, url_bytes, bplist)
+
+    writer.end_object()
+    return writer.getvalue()
+
+
+def _write_string(writer, classes, value, key=None):
+    if key is not None and writer.write_object_reference(key):
+        return
+    writer.begin_object(classes, key=key)
+    writer.write_type('+')
+    writer.write_bytes(value)
+    writer.end_object()
+
+
+def _write_attributes(writer, link, url_bytes, bplist):
+    writer.begin_object([NSDICTIONARY, NSOBJECT])
+    writer.write_type('i')
+    writer.write_int(3 if link else 1)
+
+    if link:
+        writer.write_type('@')
+        _write_string(writer, [NSSTRING, NSOBJECT], DATA_DETECTED_ATTRIBUTE)
+        writer.write_type('@')
+        writer.begin_object([NSDATA, NSOBJECT])
+        writer.write_type('i')
+        writer.write_int(len(bplist))
+        writer.write_type('[%dc]' % len(bplist))
+        writer.write(bplist)
+        writer.end_object()
+
+    writer.write_type('@')
+    _write_string(writer, [NSSTRING, NSOBJECT], MESSAGE_PART_ATTRIBUTE, key=MESSAGE_PART_ATTRIBUTE)
+    writer.write_type('@')
+    if not writer.write_object_reference('message part'):
+        writer.begin_object([NSNUMBER, NSVALUE, NSOBJECT], key='message part')
+        writer.write_type('*')
+        writer.write_c_string('i')
+        writer.write_type('i')
+        writer.write_int(0)
+        writer.end_object()
+
+    if link:
+        writer.write_type('@')
+        _write_string(writer, [NSSTRING, NSOBJECT], LINK_ATTRIBUTE)
+        writer.write_type('@')
+        writer.begin_object([NSURL, NSOBJECT])
+        writer.write_type('c')
+        writer.write_int(0)
+        writer.write_type('@')
+        _write_string(writer, [NSSTRING, NSOBJECT], url_bytes)
+        writer.end_object()
+
+    writer.end_object()
+
 
 class Sms(BaseIOC):
-    def __init__(self, backup_path, file_locator, config_file):
-        super().__init__(backup_path, file_locator)
+    REQUIRED_FIELDS = ('text', 'url', 'receivedDate', 'readDate')
+
+    def __init__(self, backup_path, file_locator, config_file, in_memory=False):
+        super().__init__(backup_path, file_locator, in_memory=in_memory)
         self.init = True
+        # Chat and handle ROWIDs by guid and phone number, loaded on the first insert and kept between chunks
+        self.chats = None
+        self.handles = None
         try:
-            self.data = super().params_file_to_dict(config_file)
-            self.filename = super().get_file_name(RELATIVE_PATH)
-            self.attrs = Files.get_file_attributes_by_relative_path(RELATIVE_PATH)
+            super().load_records(config_file)
+            super().load_manifest_record(RELATIVE_PATH)
         except Files.DoesNotExist:
             logger.info("No sms")
             self.init = False
@@ -32,93 +171,89 @@ class Sms(BaseIOC):
     def run(self):
         try:
             self.decrypt_if_needed()
-            self.insert_conversation()
-            size = os.path.getsize(self.filename)
-            self.crypt_if_needed()
-            super().update_manifest_file(RELATIVE_PATH, self.filename, size)
-            logger.info('Suspicious %s domain inserted in SMS list', self.data['url'])
+            self.insert_records()
+            digest, size = self.crypt_if_needed()
+            super().update_manifest_file(size, digest)
+            for record in self.records:
+                logger.info('Suspicious %s domain inserted in SMS list', record['url'])
         except Exception as er:
-            logger.error("Inserting Sms URL %s: %s", self.data['url'], er)
+            logger.error("Inserting Sms URLs of %s: %s", self.config_file, er)
 
-    def insert_conversation(self):
-        with db.open_sms(self.filename):
-            if 'phoneNumber' in self.data:
-                phone_number = self.data['phoneNumber']
+    def insert_records(self):
+        with db.open_sms(self.database) as sms_db:
+            with sms_db.atomic():
+                self.insert_conversations()
+
+    def insert_conversations(self):
+        """
+        Insert the messages of every record, creating their chats and handles when needed. Messages and their joins are
+        inserted in batches, copying the last received message.
+        """
+        if self.chats is None:
+            self.chats = {chat.guid: chat.ROWID
+                          for chat in Chat.select(Chat.ROWID, Chat.guid).order_by(Chat.ROWID.desc())}
+            self.handles = {handle.id: handle.ROWID
+                            for handle in Handle.select(Handle.ROWID, Handle.id).order_by(Handle.ROWID.desc())}
+
+        message_template = model_to_dict(Message.get_last(), recurse=False)
+        del message_template['ROWID']
+
+        messages = []
+        message_chats = {}
+        chat_handles = []
+        for record in self.records:
+            if 'phoneNumber' in record:
+                phone_number = record['phoneNumber']
             else:
                 phone_number = "+42" + str(randint(000000000, 999999999))
 
-            chat = Chat.get_or_none(Chat.guid == "SMS;-;" + phone_number)
-            if chat is None:
-                chat = Chat.get_last()
-                chat.ROWID = None
-                chat.guid = "SMS;-;" + phone_number
-                chat.chat_identifier = phone_number
-                chat.group_id = str(uuid.uuid4()).upper()
-                chat.is_filtered = 1
-                chat.original_group_id = str(uuid.uuid4()).upper()
-                chat.save(force_insert=True)
-
-            handle = Handle.get_or_none(Handle.id == phone_number)
-            if handle is None:
-                handle = Handle.get_last()
-                handle.ROWID = None
-                handle.id = phone_number
-                handle.uncanonicalized_id = phone_number
-                handle.save(force_insert=True)
-                ChatHandleJoin.create(chat_id=chat.ROWID, handle_id=handle.ROWID)
-
-            message = Message.get_last()
-            message.ROWID = None
-            message.handle_id = handle.ROWID
-            message.guid = uuid.uuid4()
-            message.text = self.data['text']
-
-            message.date = utils.get_macos_nanoseconds(utils.convert_timestamp_from_iso(self.data['receivedDate']))
-            message.date_read = utils.get_macos_nanoseconds(utils.convert_timestamp_from_iso(self.data['readDate']))
-            message.attributedBody = self.generate_attributed_body()
-            message.save(force_insert=True)
-
-            ChatMessageJoin.create(chat_id=chat.ROWID, message_id=message.ROWID, message_date=message.date)
-
-    def generate_attributed_body(self):
-
-        url = self.data['url']
-
-        with open("pegasus_false_positive/resources/sms-bplist-template.xml", 'rb') as f_template:
-            plist_data = plistlib.load(f_template, fmt=plistlib.FMT_XML)
-            plist_data['$objects'][6] = url
-            plist_data['$objects'][3] = len(url)
-
-        with open("pegasus_false_positive/resources/sms-template.bin", 'rb') as f_template:
-            sms = f_template.read()
-
-        if b"SMS_BPLIST" in sms:
-            logger.debug("SMS_PLIST found")
-            bplist = plistlib.dumps(plist_data, fmt=plistlib.FMT_BINARY)
-            sms = sms.replace(b"SMS_BPLIST", bplist)
-
-        if b"SMS_TEXT" in sms:
-            logger.debug("SMS_TEXT found")
-            sms = sms.replace(b"SMS_TEXT", bytes(self.data['text'], 'utf-8'))
-            # Check how length is inserted
-        if b"SMS_LENGTH" in sms:
-            logger.debug("SMS_LENGTH found")
-            logger.debug("sms_length %s", str(len(self.data['text'])))
-            sms = sms.replace(b"SMS_LENGTH", len(self.data['text']).to_bytes(1, 'big'))
-            # Check how length is inserted
-        if b"LINK_LENGTH" in sms:
-            logger.debug("LINK_LENGTH found")
-            sms = sms.replace(b"LINK_LENGTH", len(url).to_bytes(1, 'big'))
-        if b"LINK" in sms:
-            logger.debug("LINK found")
-            sms = sms.replace(b"LINK", bytes(url, 'utf-8'))
-
-        bplist_length = len(bplist)
-        if b"BPLIST_LENGTH" in sms:
-            logger.debug("BPLIST_LENGTH found")
-            sms = sms.replace(b"BPLIST_LENGTH", bytes(str(bplist_length), 'utf-8'))
-        if b"BINARY_LENGTH" in sms:
-            logger.debug("BINARY_LENGTH found")
-            sms = sms.replace(b"BINARY_LENGTH", bplist_length.to_bytes(2, 'little'))
-
-        return sms
+            chat_id = self.get_or_create_chat(phone_number)
+            handle_id = self.handles.get(phone_number)
+            if handle_id is None:
+                handle_id = self.create_handle(phone_number)
+                chat_handles.append({'chat_id': chat_id, 'handle_id': handle_id})
+
+            message = dict(message_template)
+            message['handle_id'] = handle_id
+            message['guid'] = str(uuid.uuid4())
+            message['text'] = record['text']
+            message['date'] = utils.get_macos_nanoseconds(utils.convert_timestamp_from_iso(record['receivedDate']))
+            message['date_read'] = utils.get_macos_nanoseconds(utils.convert_timestamp_from_iso(record['readDate']))
+            message['attributedBody'] = encode_attributed_body(record['text'], record['url'])
+            messages.append(message)
+            message_chats[message['guid']] = (chat_id, message['date'])
+
+        db.insert_many(ChatHandleJoin, chat_handles)
+        db.insert_many(Message, messages)
+
+        chat_messages = []
+        guids = list(message_chats)
+        for batch in peewee.chunked(guids, db.max_variables(Message)):
+            for message_id, guid in Message.select(Message.ROWID, Message.guid).where(Message.guid.in_(batch)).tuples():
+                chat_id, message_date = message_chats[guid]
+                chat_messages.append({'chat_id': chat_id, 'message_id': message_id, 'message_date': message_date})
+        db.insert_many(ChatMessageJoin, chat_messages)
+
+    def get_or_create_chat(self, phone_number):
+        guid = "SMS;-;" + phone_number
+        chat_id = self.chats.get(guid)
+        if chat_id is None:
+            chat = Chat.get_last()
+            chat.ROWID = None
+            chat.guid = guid
+            chat.chat_identifier = phone_number
+            chat.group_id = str(uuid.uuid4()).upper()
+            chat.is_filtered = 1
+            chat.original_group_id = str(uuid.uuid4()).upper()
+            chat.save(force_insert=True)
+            chat_id = self.chats[guid] = chat.ROWID
+        return chat_id
+
+    def create_handle(self, phone_number):
+        handle = Handle.get_last()
+        handle.ROWID = None
+        handle.id = phone_number
+        handle.uncanonicalized_id = phone_number
+        handle.save(force_insert=True)
+        self.handles[phone_number] = handle.ROWID
+        return handle.ROWID
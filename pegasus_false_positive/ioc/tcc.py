@@ -1,5 +1,4 @@
 import logging
-import os
 from urllib.parse import urlparse
 
 from pegasus_false_positive import db
@@ -8,17 +7,22 @@ from pegasus_false_positive.ioc.baseioc import BaseIOC
 from pegasus_false_positive.utils import utils
 
 RELATIVE_PATH = 'Library/TCC/TCC.db'
+CLIENT_TYPE_BUNDLE_ID = 0
+INDIRECT_OBJECT_UNUSED = 0
 logger = logging.getLogger('pegasus-false-positive')
 
 
 class Tcc(BaseIOC):
-    def __init__(self, backup_path, file_locator, config_file):
-        super().__init__(backup_path, file_locator)
+    REQUIRED_FIELDS = ('service', 'client', 'time')
+
+    def __init__(self, backup_path, file_locator, config_file, in_memory=False):
+        super().__init__(backup_path, file_locator, in_memory=in_memory)
         self.init = True
+        # Primary keys of the access table, loaded on the first insert and kept between chunks
+        self.access_keys = None
         try:
-            self.data = super().params_file_to_dict(config_file)
-            self.filename = super().get_file_name(RELATIVE_PATH)
-            self.attrs = Files.get_file_attributes_by_relative_path(RELATIVE_PATH)
+            super().load_records(config_file)
+            super().load_manifest_record(RELATIVE_PATH)
         except Files.DoesNotExist:
             logger.info("No Tcc")
             self.init = False
@@ -29,34 +33,44 @@ class Tcc(BaseIOC):
     def run(self):
         try:
             self.decrypt_if_needed()
-            self.update_tcc()
-            size = os.path.getsize(self.filename)
-            self.crypt_if_needed()
-            super().update_manifest_file(RELATIVE_PATH, self.filename, size)
+            self.insert_records()
+            digest, size = self.crypt_if_needed()
+            super().update_manifest_file(size, digest)
         except Exception as er:
-            logger.error("Inserting Tcc %s-%s: %s", self.data['service'], self.data['client'], er)
-
-    def update_tcc(self):
-        timestamp = utils.convert_timestamp_to_unix(utils.convert_timestamp_from_iso(self.data['time']))
-        with db.open_tcc(self.filename):
-            access = Access.get_or_none(Access.service == self.data['service'], Access.client == self.data['client'],
-                                        Access.client_type == 0, Access.indirect_object_identifier_type == 0)
-            if access is not None:
-                logger.info("Suspicious TCC data %s-%s previously inserted", self.data['service'], self.data['client'])
-                return
-            access = Access(service=self.data['service'],
-                            client=self.data['client'],
-                            client_type=0,
-                            auth_value=2,
-                            auth_reason=4,
-                            auth_version=1,
-                            csreq=None,
-                            policy_id=None,
-                            indirect_object_identifier_type=0,
-                            indirect_object_identifier="UNUSED",
-                            indirect_object_code_identity=None,
-                            flags=0,
-                            last_modified=timestamp)
-
-            access.save(force_insert=True)
-            logger.info('Suspicious TCC data %s-%s inserted', self.data['service'], self.data['client'])
+            logger.error("Inserting Tcc grants of %s: %s", self.config_file, er)
+
+    def insert_records(self):
+        with db.open_tcc(self.database) as tcc_db:
+            if self.access_keys is None:
+                query = Access.select(Access.service, Access.client, Access.client_type,
+                                      Access.indirect_object_identifier_type)
+                self.access_keys = set(query.tuples())
+
+            accesses = []
+            for record in self.records:
+                key = (record['service'], record['client'], CLIENT_TYPE_BUNDLE_ID, INDIRECT_OBJECT_UNUSED)
+                if key in self.access_keys:
+                    logger.info("Suspicious TCC data %s-%s previously inserted",
+                                record['service'], record['client'])
+                    continue
+                self.access_keys.add(key)
+                timestamp = utils.convert_timestamp_to_unix(utils.convert_timestamp_from_iso(record['time']))
+                accesses.append({'service': record['service'],
+                                 'client': record['client'],
+                                 'client_type': CLIENT_TYPE_BUNDLE_ID,
+                                 'auth_value': 2,
+                                 'auth_reason': 4,
+                                 'auth_version': 1,
+                                 'csreq': None,
+                                 'policy_id': None,
+                                 'indirect_object_identifier_type': INDIRECT_OBJECT_UNUSED,
+                                 'indirect_object_identifier': "UNUSED",
+                                 'indirect_object_code_identity': None,
+                                 'flags': 0,
+                                 'last_modified': timestamp})
+
+            with tcc_db.atomic():
+                db.insert_many(Access, accesses)
+
+            for access in accesses:
+                logger.info('Suspicious TCC data %s-%s inserted', access['service'], access['client'])
@@ -1,19 +1,12 @@
 import argparse
 import logging
 import pathlib
+import re
+import time
 
-from ioc.chrome_history import ChromeHistory
-from ioc.data_usage import DataUsage
-from ioc.file import File
-from ioc.osad import Osad
-from ioc.process import Process
-from ioc.safari_history import SafariHistory
-from ioc.sms import Sms
-from pegasus_false_positive import db
-from pegasus_false_positive.ioc.chrome_favicon import ChromeFavicon
-from pegasus_false_positive.ioc.safari_state import SafariState
-from pegasus_false_positive.ioc.tcc import Tcc
-from pegasus_false_positive.utils import fileutils
+from pegasus_false_positive import db, ioc, scheduler
+from pegasus_false_positive.utils import fileutils, jsonl
+from pegasus_false_positive.utils.keycache import KeyCache
 
 # 3d0d7e5fb2ce288813306e4d4636395e047a3d28 --> Library/SMS/sms.db
 # 1a0e7afc19d307da602ccdcece51af33afe92c53 --> Library/Safari/History.db
@@ -30,10 +23,8 @@ log_handler = logging.StreamHandler()
 formatter = logging.Formatter('%(levelname)s - %(message)s')
 log_handler.setFormatter(formatter)
 
-MANIFEST_DB = "Manifest.db"
 
-
-def main():
+def build_parser():
     parser = argparse.ArgumentParser(prog="pegasus-false-positive", description='', exit_on_error=False)
     parser.add_argument('--debug', action='store_true', help='activate debug mode')
     parser.add_argument('--insert-sms', default="examples/sms.json", type=str, help='json file with sms properties')
@@ -53,18 +44,106 @@ def main():
     parser.add_argument('--insert-file', default="examples/file.json", type=str, help='json file with file properties')
     parser.add_argument('--insert-osad', default="examples/osad.json", type=str,
                         help='json file with osanalytics addaily properties')
+    parser.add_argument('--insert-records', type=str,
+                        help='jsonl file with one record per line of any IOC, given by its "ioc" field, e.g. "sms"')
+    parser.add_argument('--chunk-size', type=int, default=10000,
+                        help='number of records of --insert-records inserted at once')
+    parser.add_argument('--output', type=str,
+                        help='folder where the modified backup is created, linking the files it does not change')
     parser.add_argument('--password', type=str, help='Backup Password')
+    parser.add_argument('--jobs', type=int, default=1, help='number of IOCs run concurrently')
+    parser.add_argument('--in-memory', action='store_true',
+                        help='edit the SQLite databases in memory instead of writing them decrypted to disk')
+    parser.add_argument('--sqlite-pragma', action='append', metavar='NAME=VALUE',
+                        help='pragma set on the databases while they are edited, overriding the defaults')
+    parser.add_argument('--key-cache', type=str, help='folder to cache the key derived from the backup password')
+    parser.add_argument('--key-cache-ttl', type=int, help='seconds before a cached key expires')
+    parser.add_argument('--clear-key-cache', action='store_true', help='remove all the keys cached in --key-cache')
     parser.add_argument('backup', type=str, help='iPhone backup folder')
-
-    # Retrieve arguments
-    args = parser.parse_args()
-
-    if not args.debug:
-        log_handler.setLevel(logging.INFO)
-
-    logger.addHandler(log_handler)
+    return parser
+
+
+def insert_records(backup_path, file_locator, args, selected):
+    """
+    Stream the records of args.insert_records into their IOCs in chunks of args.chunk_size records, so memory does not
+    grow with the size of the file. Every IOC edits a single backup file, so the IOCs in selected, by name, take the
+    streamed records of their type after their own ones, and each file is decrypted and written back once.
+    """
+    scheduler.run_iocs([selected_ioc for name, selected_ioc in selected.items() if name not in ioc.STREAM_IOCS],
+                       jobs=args.jobs)
+
+    iocs = {}
+    failed = set()
+
+    def insert_chunk(record_type, chunk, source):
+        record_ioc = iocs.get(record_type)
+        if record_ioc is None:
+            record_ioc = selected.get(record_type)
+            if record_ioc is None:
+                record_ioc = ioc.create(record_type, backup_path, file_locator, None, in_memory=args.in_memory)
+            iocs[record_type] = record_ioc
+        if not record_ioc.init or record_type in failed:
+            return
+        try:
+            record_ioc.insert_chunk(chunk)
+            logger.debug('%d %s records of %s inserted', len(chunk), record_type, source)
+        except Exception as er:
+            logger.error("Inserting %s records of %s: %s", record_type, source, er)
+            failed.add(record_type)
+
+    for name, selected_ioc in selected.items():
+        if name in ioc.STREAM_IOCS:
+            insert_chunk(name, selected_ioc.records, selected_ioc.config_file)
+
+    schemas = jsonl.Schemas(ioc.required_fields)
+    records = jsonl.read_records(args.insert_records, schemas)
+    for record_type, chunk in jsonl.chunk_records(records, max(args.chunk_size, 1)):
+        insert_chunk(record_type, chunk, args.insert_records)
+
+    # Every chunk is inserted in its own transaction, so the decrypted files are written back even after a failed chunk,
+    # while a file that failed to decrypt is left untouched. A failed write back is only logged, so the other files are
+    # still written back and their Manifest updates applied
+    not_written = set()
+
+    def finish_chunks(record_ioc):
+        try:
+            record_ioc.finish_chunks()
+        except Exception as er:
+            logger.error("Writing back %s: %s", record_ioc.filename, er)
+            not_written.add(record_ioc)
+
+    decrypted = [record_ioc for record_ioc in iocs.values() if record_ioc.init and record_ioc.database is not None]
+    scheduler.run_iocs(decrypted, jobs=args.jobs, step=finish_chunks)
+    for record_type, record_ioc in iocs.items():
+        if record_ioc.init and record_type not in failed and record_ioc not in not_written:
+            logger.info('Suspicious %s records inserted', record_type)
+
+
+def parse_pragmas(settings):
+    pragmas = dict(db.FAST_PRAGMAS)
+    for setting in settings or ():
+        match = re.fullmatch(r'(\w+)=([\w.-]+)', setting)
+        if match is None:
+            raise ValueError('Invalid SQLite pragma: %s' % setting)
+        pragmas[match.group(1).lower()] = match.group(2)
+    return pragmas
+
+
+def run(args):
+    """
+    Inject the IOCs selected in args into the args.backup folder. Returns the seconds spent in each phase.
+    """
+    timings = {}
+    start = time.perf_counter()
 
     backup_path = args.backup
+    if args.output:
+        fileutils.create_overlay(backup_path, args.output)
+        backup_path = args.output
+
+    key_cache = None
+    if args.key_cache:
+        key_cache = KeyCache(args.key_cache, ttl=args.key_cache_ttl)
 
     manifest_plist = fileutils.open_manifest_plist(backup_path)
 
@@ -73,66 +152,57 @@ def main():
 
     file_locator = None
     if manifest_plist['IsEncrypted']:
-        file_locator = fileutils.create_file_locator(manifest_plist, backup_path, password=args.password)
-        file_locator.decrypt_manifest()
+        file_locator = fileutils.create_file_locator(manifest_plist, backup_path, password=args.password,
+                                                   key_cache=key_cache)
 
     if not pathlib.Path(backup_path).is_dir():
         logger.error("Backup is not a folder: %s", backup_path)
 
-    with db.open_manifest(pathlib.Path(backup_path) / MANIFEST_DB):
-
-        if args.insert_sms:
-            sms = Sms(backup_path, file_locator, args.insert_sms)
-            if sms.init:
-                sms.run()
-
-        if args.insert_osad:
-            osad = Osad(backup_path, file_locator, args.insert_osad)
-            if osad.init:
-                osad.run()
-
-        if args.insert_tcc:
-            tcc = Tcc(backup_path, file_locator, args.insert_tcc)
-            if tcc.init:
-                tcc.run()
-
-        if args.insert_file:
-            file = File(backup_path, file_locator, args.insert_file)
-            if file.init:
-                file.run()
-
-        if args.insert_data_usage:
-            data_usage = DataUsage(backup_path, file_locator, args.insert_data_usage)
-            if data_usage.init:
-                data_usage.run()
-
-        if args.insert_safari:
-            safari = SafariHistory(backup_path, file_locator, args.insert_safari)
-            if safari.init:
-                safari.run()
-
-        if args.insert_safari_state:
-            safari_state = SafariState(backup_path, file_locator, args.insert_safari_state)
-            if safari_state.init:
-                safari_state.run()
-
-        if args.insert_chrome:
-            chrome = ChromeHistory(backup_path, file_locator, args.insert_chrome)
-            if chrome.init:
-                chrome.run()
-
-        if args.insert_chrome_favicon:
-            chrome_favicon = ChromeFavicon(backup_path, file_locator, args.insert_chrome_favicon)
-            if chrome_favicon.init:
-                chrome_favicon.run()
-
-        if args.insert_process:
-            process = Process(backup_path, file_locator, args.insert_process)
-            if hasattr(process, 'data'):
-                process.run()
+    manifest_db = db.MemoryDatabase(fileutils.read_manifest_db(backup_path, file_locator))
+    timings['open'] = time.perf_counter() - start
 
-    if manifest_plist['IsEncrypted']:
-        file_locator.encrypt_manifest()
+    pragmas = parse_pragmas(args.sqlite_pragma)
+    with db.session(pragmas, copies=bool(args.output)), db.open_manifest(manifest_db):
+        selected = {}
+        for name in ioc.IOCS:
+            config_file = getattr(args, 'insert_' + name)
+            if config_file:
+                selected_ioc = ioc.create(name, backup_path, file_locator, config_file, in_memory=args.in_memory)
+                if selected_ioc.init:
+                    selected[name] = selected_ioc
+
+        start = time.perf_counter()
+        if args.insert_records:
+            insert_records(backup_path, file_locator, args, selected)
+            timings['records'] = time.perf_counter() - start
+        else:
+            scheduler.run_iocs(list(selected.values()), jobs=args.jobs)
+            timings['iocs'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fileutils.write_manifest_db(backup_path, manifest_db.data, file_locator)
+    timings['manifest'] = time.perf_counter() - start
+
+    return timings
+
+
+def main():
+    parser = build_parser()
+
+    # Retrieve arguments
+    args = parser.parse_args()
+    if args.clear_key_cache and not args.key_cache:
+        parser.error('--clear-key-cache requires --key-cache')
+
+    if not args.debug:
+        log_handler.setLevel(logging.INFO)
+
+    logger.addHandler(log_handler)
+
+    if args.key_cache and args.clear_key_cache:
+        KeyCache(args.key_cache).clear()
+
+    run(args)
 
 
 if __name__ == '__main__':
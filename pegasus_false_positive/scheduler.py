@@ -0,0 +1,72 @@
+import functools
+import logging
+import operator
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('pegasus-false-positive')
+
+
+class OrderedLogHandler(logging.Handler):
+    """
+    Hold back the records logged from worker threads, so they can be emitted through the target handlers in IOC
+    order. Records logged from any other thread go straight to the targets.
+    """
+
+    def __init__(self, targets):
+        super().__init__()
+        self.targets = targets
+        self.local = threading.local()
+
+    def emit(self, record):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            self.replay([record])
+        else:
+            buffer.append(record)
+
+    def capture(self, function):
+        self.local.buffer = []
+        try:
+            function()
+        finally:
+            buffer, self.local.buffer = self.local.buffer, None
+        return buffer
+
+    def replay(self, records):
+        for record in records:
+            for target in self.targets:
+                if record.levelno >= target.level:
+                    target.handle(record)
+
+
+def run_iocs(iocs, jobs=1, step=operator.methodcaller('run')):
+    """
+    Run step(ioc) for every IOC, jobs at a time. Each IOC edits its own backup file in a worker thread while
+    its Manifest updates are queued, and then applied in IOC order from the calling thread, which is the only one that
+    owns Manifest.db.
+    """
+    if jobs <= 1 or len(iocs) <= 1:
+        for ioc in iocs:
+            step(ioc)
+        return
+
+    handlers = list(logger.handlers)
+    ordered_handler = OrderedLogHandler(handlers)
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(ordered_handler)
+
+    try:
+        for ioc in iocs:
+            ioc.defer_manifest_updates = True
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(ordered_handler.capture, functools.partial(step, ioc)) for ioc in iocs]
+            for ioc, future in zip(iocs, futures):
+                ordered_handler.replay(future.result())
+                ioc.apply_manifest_updates()
+    finally:
+        logger.removeHandler(ordered_handler)
+        for handler in handlers:
+            logger.addHandler(handler)
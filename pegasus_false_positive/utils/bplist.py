@@ -0,0 +1,149 @@
+import struct
+
+# See https://opensource.apple.com/source/CF/CF-1153.18/CFBinaryPList.c
+
+BPLIST_MAGIC = b'bplist00'
+TRAILER = struct.Struct('>6xBBQQQ')
+
+TYPE_INT = 0x1
+TYPE_DATA = 0x4
+TYPE_ASCII = 0x5
+TYPE_UTF16 = 0x6
+TYPE_UID = 0x8
+TYPE_ARRAY = 0xA
+TYPE_SET = 0xC
+TYPE_DICT = 0xD
+LENGTH_TYPES = (TYPE_DATA, TYPE_ASCII, TYPE_UTF16, TYPE_ARRAY, TYPE_SET, TYPE_DICT)
+
+
+class BinaryPlist:
+    """
+    Minimal reader of the binary plist object table, enough to locate objects and rewrite scalars in place.
+    """
+
+    def __init__(self, data):
+        if data[:len(BPLIST_MAGIC)] != BPLIST_MAGIC or len(data) < len(BPLIST_MAGIC) + TRAILER.size:
+            raise ValueError('not a binary plist')
+        self.data = data
+        self.offset_size, self.ref_size, num_objects, self.top, table_offset = TRAILER.unpack(data[-TRAILER.size:])
+        self.offsets = [self._read_int(table_offset + i * self.offset_size, self.offset_size)
+                        for i in range(num_objects)]
+
+    def _read_int(self, offset, size):
+        return int.from_bytes(self.data[offset:offset + size], 'big')
+
+    def _header(self, ref):
+        """
+        Returns the type, length and position of the payload of an object.
+        """
+        offset = self.offsets[ref]
+        marker = self.data[offset]
+        obj_type, info = marker >> 4, marker & 0xF
+        offset += 1
+        if obj_type in LENGTH_TYPES and info == 0xF:
+            int_marker = self.data[offset]
+            if int_marker >> 4 != TYPE_INT:
+                raise ValueError('invalid object length')
+            int_size = 1 << (int_marker & 0xF)
+            info = self._read_int(offset + 1, int_size)
+            offset += 1 + int_size
+        return obj_type, info, offset
+
+    def refs(self, ref):
+        obj_type, count, offset = self._header(ref)
+        if obj_type == TYPE_DICT:
+            count *= 2
+        elif obj_type not in (TYPE_ARRAY, TYPE_SET):
+            return []
+        return [self._read_int(offset + i * self.ref_size, self.ref_size) for i in range(count)]
+
+    def dict_items(self, ref):
+        obj_type, count, offset = self._header(ref)
+        if obj_type != TYPE_DICT:
+            raise ValueError('object %d is not a dict' % ref)
+        refs = self.refs(ref)
+        return zip(refs[:count], refs[count:])
+
+    def string(self, ref):
+        obj_type, length, offset = self._header(ref)
+        if obj_type == TYPE_ASCII:
+            return self.data[offset:offset + length].decode('ascii')
+        if obj_type == TYPE_UTF16:
+            return self.data[offset:offset + length * 2].decode('utf-16be')
+        return None
+
+    def uid(self, ref):
+        offset = self.offsets[ref]
+        marker = self.data[offset]
+        if marker >> 4 != TYPE_UID:
+            raise ValueError('object %d is not a UID' % ref)
+        return self._read_int(offset + 1, (marker & 0xF) + 1)
+
+    def dict_value(self, ref, key):
+        for key_ref, value_ref in self.dict_items(ref):
+            if self.string(key_ref) == key:
+                return value_ref
+        raise KeyError(key)
+
+    def array_item(self, ref, index):
+        obj_type, count, offset = self._header(ref)
+        if obj_type != TYPE_ARRAY or index >= count:
+            raise ValueError('object %d has no item %d' % (ref, index))
+        return self._read_int(offset + index * self.ref_size, self.ref_size)
+
+    def reference_count(self, target):
+        count = int(self.top == target)
+        for ref in range(len(self.offsets)):
+            count += self.refs(ref).count(target)
+        return count
+
+    def data_span(self, ref):
+        obj_type, length, offset = self._header(ref)
+        if obj_type != TYPE_DATA:
+            raise ValueError('object %d is not data' % ref)
+        return offset, length
+
+    def int_span(self, ref):
+        offset = self.offsets[ref]
+        marker = self.data[offset]
+        if marker >> 4 != TYPE_INT or marker & 0xF > 3:
+            raise ValueError('object %d is not a 64 bit integer' % ref)
+        return offset + 1, 1 << (marker & 0xF)
+
+
+def _int_fits(value, size):
+    if size == 8:
+        return -(1 << 63) <= value < (1 << 63)
+    return 0 <= value < (1 << (8 * size))
+
+
+def patch_mbfile(blob, digest, size):
+    """
+    Patch the Digest and $objects[1]['Size'] of an MBFile NSKeyedArchiver blob in place. The Digest is left alone when
+    the record has none. Returns None when the new values do not fit in the existing objects, or when those objects are
+    shared, so the caller can fall back to a full re-encode.
+    """
+    try:
+        plist = BinaryPlist(blob)
+        objects = plist.dict_value(plist.top, '$objects')
+        mbfile = plist.array_item(objects, 1)
+        size_ref = plist.dict_value(mbfile, 'Size')
+        size_offset, size_width = plist.int_span(size_ref)
+        if not _int_fits(size, size_width) or plist.reference_count(size_ref) != 1:
+            return None
+
+        patched = bytearray(blob)
+        patched[size_offset:size_offset + size_width] = size.to_bytes(size_width, 'big', signed=size < 0)
+        try:
+            digest_uid = plist.dict_value(mbfile, 'Digest')
+        except KeyError:
+            return bytes(patched)
+        digest_ref = plist.array_item(objects, plist.uid(digest_uid))
+        digest_offset, digest_length = plist.data_span(digest_ref)
+        if digest_length != len(digest) or plist.reference_count(digest_ref) != 1:
+            return None
+    except (ValueError, KeyError, IndexError):
+        return None
+
+    patched[digest_offset:digest_offset + digest_length] = digest
+    return bytes(patched)
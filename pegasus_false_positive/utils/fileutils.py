@@ -1,13 +1,22 @@
 import hashlib
 import logging
+import mmap
+import os
 import pathlib
 import plistlib
+import shutil
+from io import BytesIO
 
-from pegasus_false_positive.utils import iosbackupcrypt
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 MANIFEST_DB_PATH = 'Manifest.db'
 MANIFEST_PLIST_PATH = 'Manifest.plist'
 BUF_SIZE = 65536
+# ioctl that makes a file share the extents of another one, on Btrfs, XFS and other copy-on-write filesystems
+FICLONE = 0x40049409
 
 logger = logging.getLogger('pegasus-false-positive')
 
@@ -23,6 +32,20 @@ def hash_file(file):
     return sha1.digest()
 
 
+def hash_file_mmap(file):
+    """
+    SHA-1 digest and size of file. The file is hashed through mmap, so big files need neither read buffers nor copies.
+    """
+    sha1 = hashlib.sha1()
+
+    with open(file, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                sha1.update(data)
+    return sha1.digest(), size
+
+
 def open_manifest_plist(backup_path):
     manifest_file = pathlib.Path(backup_path) / MANIFEST_PLIST_PATH
     try:
@@ -39,9 +62,73 @@ def open_manifest_plist(backup_path):
         logger.error("Manifest.plist does not exist in this path: %s", manifest_file)
 
 
-def create_file_locator(manifest, base, password=None):
+def create_file_locator(manifest, base, password=None, key_cache=None):
     if manifest['IsEncrypted']:
-        return FileLocatorBackupEncrypted(base, manifest, password=password)
+        return FileLocatorBackupEncrypted(base, manifest, password=password, key_cache=key_cache)
+
+
+def read_manifest_db(backup_path, file_locator=None):
+    if file_locator is not None:
+        return file_locator.read_manifest()
+    with open(pathlib.Path(backup_path) / MANIFEST_DB_PATH, 'rb') as f:
+        return f.read()
+
+
+def write_manifest_db(backup_path, data, file_locator=None):
+    """
+    Replace Manifest.db in a single atomic write, so an interrupted run never leaves it half written or decrypted.
+    """
+    if file_locator is not None:
+        file_locator.write_manifest(data)
+    else:
+        replace_file(pathlib.Path(backup_path) / MANIFEST_DB_PATH, lambda dst: dst.write(data))
+
+
+def reflink_file(src, dst):
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+
+
+def create_overlay(backup_path, output_path):
+    """
+    Create in output_path a backup whose files share their data with the ones in backup_path: reflinks where the
+    filesystem supports them, hard links otherwise, and copies across filesystems. Files are always replaced or detached
+    before being edited, so the edits never reach backup_path.
+    """
+    backup_path = pathlib.Path(backup_path).resolve()
+    output_path = pathlib.Path(output_path).resolve()
+    if output_path == backup_path or backup_path in output_path.parents:
+        raise ValueError('The output folder must be outside the backup: %s' % output_path)
+    if output_path.exists() and any(output_path.iterdir()):
+        raise FileExistsError('The output folder is not empty: %s' % output_path)
+
+    # Once a reflink fails every other file is on the same filesystem, so it is not tried again
+    reflink = fcntl is not None
+    for root, _, files in os.walk(backup_path):
+        target = output_path / os.path.relpath(root, backup_path)
+        target.mkdir(parents=True, exist_ok=True)
+        for name in files:
+            src, dst = os.path.join(root, name), target / name
+            if reflink:
+                try:
+                    reflink_file(src, dst)
+                    continue
+                except OSError:
+                    reflink = False
+                    dst.unlink(missing_ok=True)
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copy2(src, dst)
+
+
+def detach_file(file):
+    """
+    Give a hard linked file its own copy of the data, so it can be edited in place without changing the other links.
+    """
+    if os.stat(file).st_nlink > 1:
+        with open(file, 'rb') as src:
+            replace_file(file, lambda dst: shutil.copyfileobj(src, dst, BUF_SIZE))
 
 
 def get_file_id(domain, path):
@@ -64,45 +151,109 @@ def get_encryption_key(attrs):
         return None
 
 
+class DigestWriter:
+    """
+    File wrapper that computes the SHA-1 digest and size of everything written through it.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.sha1 = hashlib.sha1()
+        self.size = 0
+
+    def write(self, data):
+        self.sha1.update(data)
+        self.size += len(data)
+        return self.f.write(data)
+
+    def digest(self):
+        return self.sha1.digest()
+
+
+def replace_file(file, write):
+    """
+    Write file through write(dst) into a temporary sibling and replace the original with it.
+    Returns the DigestWriter used as dst.
+    """
+    file = pathlib.Path(file)
+    tmp_file = file.with_name(file.name + '.tmp')
+    try:
+        with open(tmp_file, 'wb') as f:
+            dst = DigestWriter(f)
+            write(dst)
+        os.replace(tmp_file, file)
+    except BaseException:
+        tmp_file.unlink(missing_ok=True)
+        raise
+    return dst
+
+
+def rewrite_file(file, transform):
+    """
+    Stream file through transform(src, dst) and replace the original with the result.
+    Returns the digest of the new content and the size of the original one.
+    """
+    with open(file, 'rb') as src:
+        dst = replace_file(file, lambda dst: transform(src, dst))
+        return dst.digest(), src.tell()
+
+
 class FileLocatorBackupEncrypted:
-    def __init__(self, backup_path, manifest, password):
+    def __init__(self, backup_path, manifest, password, key_cache=None):
+        # PyCryptodome is only imported for encrypted backups
+        from pegasus_false_positive.utils import iosbackupcrypt
+
         self.backup_path = backup_path
-        self.crypt = iosbackupcrypt.CryptUtil(manifest, password)
+        self.crypt = iosbackupcrypt.CryptUtil(manifest, password, key_cache=key_cache)
 
     def decrypt_file(self, file, attrs):
-        with open(file, 'rb') as f:
-            data = f.read()
-
         enc_key = get_encryption_key(attrs)
 
         if enc_key:
-            with open(file, 'wb') as f:
-                f.write(self.crypt.decrypt(data, enc_key))
+            rewrite_file(file, lambda src, dst: self.crypt.decrypt_stream(src, dst, enc_key))
 
     def encrypt_file(self, file, attrs):
-        with open(file, 'rb') as f:
-            data = f.read()
-
         enc_key = get_encryption_key(attrs)
 
         if enc_key:
-            with open(file, 'wb') as f:
-                f.write(self.crypt.encrypt(data, enc_key))
+            return rewrite_file(file, lambda src, dst: self.crypt.encrypt_stream(src, dst, enc_key))
+        return hash_file(file), os.path.getsize(file)
 
-    def decrypt_manifest(self):
-        with open(pathlib.Path(self.backup_path) / MANIFEST_DB_PATH, 'rb') as f:
-            encrypted_db = f.read()
+    def copy_file(self, src_file, file, attrs):
+        enc_key = get_encryption_key(attrs)
 
-        decrypted_data = self.crypt.decrypt_manifest(encrypted_db)
+        with open(src_file, 'rb') as src:
+            if enc_key:
+                dst = replace_file(file, lambda dst: self.crypt.encrypt_stream(src, dst, enc_key))
+            else:
+                dst = replace_file(file, lambda dst: shutil.copyfileobj(src, dst, BUF_SIZE))
+            return dst.digest(), src.tell()
 
-        with open(pathlib.Path(self.backup_path) / MANIFEST_DB_PATH, 'wb') as f:
-            f.write(decrypted_data)
+    def read_file(self, file, attrs):
+        enc_key = get_encryption_key(attrs)
 
-    def encrypt_manifest(self):
-        with open(pathlib.Path(self.backup_path) / MANIFEST_DB_PATH, 'rb') as f:
-            unencrypted_db = f.read()
+        with open(file, 'rb') as src:
+            if not enc_key:
+                return src.read()
+            dst = BytesIO()
+            self.crypt.decrypt_stream(src, dst, enc_key)
+            return dst.getvalue()
+
+    def write_file(self, file, attrs, data):
+        enc_key = get_encryption_key(attrs)
+
+        if enc_key:
+            dst = replace_file(file, lambda dst: self.crypt.encrypt_stream(BytesIO(data), dst, enc_key))
+        else:
+            dst = replace_file(file, lambda dst: dst.write(data))
+        return dst.digest(), len(data)
 
-        encrypted_data = self.crypt.encrypt_manifest(unencrypted_db)
+    def read_manifest(self):
+        with open(pathlib.Path(self.backup_path) / MANIFEST_DB_PATH, 'rb') as src:
+            dst = BytesIO()
+            self.crypt.decrypt_manifest_stream(src, dst)
+            return dst.getvalue()
 
-        with open(pathlib.Path(self.backup_path) / MANIFEST_DB_PATH, 'wb') as f:
-            f.write(encrypted_data)
+    def write_manifest(self, data):
+        replace_file(pathlib.Path(self.backup_path) / MANIFEST_DB_PATH,
+                     lambda dst: self.crypt.encrypt_manifest_stream(BytesIO(data), dst))
@@ -1,11 +1,14 @@
 import hashlib as hlib
 import logging
 import os
+import shutil
 import struct
 
 from Crypto.Cipher import AES
 
 QUAD = struct.Struct('>Q')
+AES_BLOCK_SIZE = 16
+CHUNK_SIZE = 1024 * 1024  # Must be a multiple of AES_BLOCK_SIZE
 logger = logging.getLogger('pegasus-false-positive')
 
 
@@ -86,7 +89,7 @@ def aes_wrap_key_withpad(kek, plaintext):
 
 
 class CryptUtil:
-    def __init__(self, manifest, password):
+    def __init__(self, manifest, password, key_cache=None):
         self.manifest = manifest
         self.attrs = {}
         self.uuid = None
@@ -95,12 +98,29 @@ class CryptUtil:
         self.CLASSKEY_TAGS = [b"CLAS", b"WRAP", b"WPKY", b"KTYP", b"PBKY"]  # UUID
         self.classKeys = {}
         self.__load_keys()
-        if password:
-            self.decryptionKey = self.__derive_key_from_password(password.encode('utf-8'))
-        else:
+        if not password:
             raise Exception("Password required")
+
+        password = password.encode('utf-8')
+        cache_id = None
+        if key_cache is not None:
+            cache_id = key_cache.entry_id(self.uuid, self.attrs)
+            self.decryptionKey = key_cache.get(cache_id, password)
+            if self.decryptionKey is not None:
+                try:
+                    self.__unlock_keys()
+                    logger.debug('Using cached backup key')
+                    return
+                except ValueError:
+                    logger.warning('Cached backup key is not valid, deriving it again')
+                    key_cache.invalidate(cache_id)
+
+        self.decryptionKey = self.__derive_key_from_password(password)
         self.__unlock_keys()
 
+        if key_cache is not None:
+            key_cache.put(cache_id, self.decryptionKey, password)
+
     def __load_keys(self):
         backup_key_bag = self.manifest['BackupKeyBag']
         current_class_key = None
@@ -145,26 +165,53 @@ class CryptUtil:
         return decryption_key
 
     @staticmethod
-    def __aes_decrypt_cbc(data, key, iv=b'\x00' * 16, padding=False):
-        todec = data
-
-        if len(data) % 16:
-            todec = data[0:(len(data) / 16) * 16]
-
-        dec = AES.new(key, AES.MODE_CBC, iv).decrypt(todec)
+    def __aes_decrypt_cbc_stream(src, dst, key, iv=b'\x00' * 16, padding=False):
+        """
+        Decrypt src into dst chunk by chunk. The cipher object keeps the CBC state between chunks, and the last
+        decrypted chunk is held back so the padding can be removed before it is written.
+        """
+        cipher = AES.new(key, AES.MODE_CBC, iv)
+        last = None
+
+        while True:
+            chunk = src.read(CHUNK_SIZE)
+            if len(chunk) % AES_BLOCK_SIZE:
+                chunk = chunk[0:(len(chunk) // AES_BLOCK_SIZE) * AES_BLOCK_SIZE]
+            if not chunk:
+                break
+            if last is not None:
+                dst.write(last)
+            last = cipher.decrypt(chunk)
+
+        if last is None:
+            return
 
         if padding:
-            dec = CryptUtil.__remove_padding(16, dec)
+            last = CryptUtil.__remove_padding(AES_BLOCK_SIZE, last)
 
-        return dec
+        dst.write(last)
 
     @staticmethod
-    def __aes_encrypt_cbc(data, key, iv=b'\x00' * 16, padding=False):
+    def __aes_encrypt_cbc_stream(src, dst, key, iv=b'\x00' * 16, padding=False):
+        """
+        Encrypt src into dst chunk by chunk. Only the final chunk is padded.
+        """
+        cipher = AES.new(key, AES.MODE_CBC, iv)
+        chunk = src.read(CHUNK_SIZE)
+
+        while True:
+            next_chunk = src.read(CHUNK_SIZE)
+            if not next_chunk:
+                break
+            dst.write(cipher.encrypt(chunk))
+            chunk = next_chunk
+
         if padding:
-            padding = 16 - (len(data) % 16)
-            data = data + padding.to_bytes(1, 'little') * padding
+            padding = AES_BLOCK_SIZE - (len(chunk) % AES_BLOCK_SIZE)
+            chunk += padding.to_bytes(1, 'little') * padding
 
-        return AES.new(key, AES.MODE_CBC, iv).encrypt(data)
+        if chunk:
+            dst.write(cipher.encrypt(chunk))
 
     @staticmethod
     def __remove_padding(blocksize, s):
@@ -240,29 +287,27 @@ class CryptUtil:
 
         return self.__unwrap_key_for_class(manifest_class, manifest_key)
 
-    def encrypt_manifest(self, data):
+    def encrypt_manifest_stream(self, src, dst):
         if self.__is_older_than_ios_10_2(self.manifest['Lockdown']['ProductVersion']):
-            return data
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
         else:
-            return self.__aes_encrypt_cbc(data, self.__get_manifest_key())
+            self.__aes_encrypt_cbc_stream(src, dst, self.__get_manifest_key())
 
-    def decrypt_manifest(self, data):
+    def decrypt_manifest_stream(self, src, dst):
         if self.__is_older_than_ios_10_2(self.manifest['Lockdown']['ProductVersion']):
-            return data
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
         else:
-            return self.__aes_decrypt_cbc(data, self.__get_manifest_key())
+            self.__aes_decrypt_cbc_stream(src, dst, self.__get_manifest_key())
 
-    def decrypt(self, data, enc_key_params):
+    def decrypt_stream(self, src, dst, enc_key_params):
         key = self.__unwrap_key_for_class(enc_key_params[0], enc_key_params[1])
 
-        # See https://github.com/avibrazil/iOSbackup/issues/1
-        return self.__aes_decrypt_cbc(data, key, padding=True)
+        self.__aes_decrypt_cbc_stream(src, dst, key, padding=True)
 
-    def encrypt(self, data, enc_key_params):
+    def encrypt_stream(self, src, dst, enc_key_params):
         key = self.__unwrap_key_for_class(enc_key_params[0], enc_key_params[1])
 
-        # See https://github.com/avibrazil/iOSbackup/issues/1
-        return self.__aes_encrypt_cbc(data, key, padding=True)
+        self.__aes_encrypt_cbc_stream(src, dst, key, padding=True)
 
     def create_key(self, protection_class):
         return self.__wrap_key_for_class(protection_class, os.urandom(32))
@@ -0,0 +1,68 @@
+import json
+import logging
+
+logger = logging.getLogger('pegasus-false-positive')
+
+IOC_FIELD = 'ioc'
+
+
+class Schemas(dict):
+    """
+    Required fields of each record type, in the form used by read_records so records are checked with a single set
+    comparison. The fields of a type are looked up through required_fields(type) the first time it is read, which
+    raises KeyError for unknown types.
+    """
+
+    def __init__(self, required_fields):
+        super().__init__()
+        self.required_fields = required_fields
+
+    def __missing__(self, record_type):
+        fields = self[record_type] = frozenset(self.required_fields(record_type))
+        return fields
+
+
+def read_records(filename, schemas):
+    """
+    Lazily yield the (type, record) pairs of a JSON Lines file, one record per line with its IOC in the "ioc" field.
+    Invalid lines are logged and skipped.
+    """
+    with open(filename) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                record_type = record.pop(IOC_FIELD)
+                required = schemas[record_type]
+            except json.JSONDecodeError as e:
+                logger.error('%s:%d: %s', filename, line_number, e)
+                continue
+            except (KeyError, TypeError, AttributeError):
+                logger.error('%s:%d: unknown IOC', filename, line_number)
+                continue
+
+            if not required <= record.keys():
+                logger.error('%s:%d: %s record without %s', filename, line_number, record_type,
+                             ', '.join(sorted(required - record.keys())))
+                continue
+
+            yield record_type, record
+
+
+def chunk_records(records, chunk_size):
+    """
+    Group (type, record) pairs into (type, list of records) chunks of chunk_size records. At most one partial chunk per
+    type is held in memory, and the partial chunks are yielded once the records are exhausted.
+    """
+    chunks = {}
+    for record_type, record in records:
+        chunk = chunks.setdefault(record_type, [])
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            yield record_type, chunk
+            chunks[record_type] = []
+
+    for record_type, chunk in chunks.items():
+        if chunk:
+            yield record_type, chunk
@@ -0,0 +1,95 @@
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import time
+
+logger = logging.getLogger('pegasus-false-positive')
+
+
+# PBKDF2 iterations of the key that wraps a cached key: far fewer than the keybag ones, but enough that the cache does
+# not make guessing the password cheap
+WRAP_ITERATIONS = 200000
+WRAP_SALT_SIZE = 16
+
+
+class KeyCache:
+    """
+    On-disk keyring for password derived backup keys. Entries are keyed by the keybag UUID, its salts and
+    iteration counts, and hold the key wrapped with a key derived from the password, so a different password fails to
+    unwrap it and never hits a cached key.
+    """
+
+    def __init__(self, path, ttl=None):
+        self.path = pathlib.Path(path)
+        self.ttl = ttl
+
+    @staticmethod
+    def entry_id(uuid, attrs):
+        sha256 = hashlib.sha256()
+        sha256.update(uuid or b'')
+        for tag in (b"SALT", b"ITER", b"DPSL", b"DPIC"):
+            value = attrs.get(tag, b'')
+            if isinstance(value, int):
+                value = value.to_bytes(8, 'big')
+            sha256.update(tag + len(value).to_bytes(4, 'big') + value)
+        return sha256.hexdigest()
+
+    def _entry_path(self, entry_id):
+        return self.path / (entry_id + '.json')
+
+    @staticmethod
+    def _wrapping_key(password, salt):
+        return hashlib.pbkdf2_hmac('sha256', password, salt, WRAP_ITERATIONS, 32)
+
+    def get(self, entry_id, password):
+        # The AES key wrap is only needed for encrypted backups, so PyCryptodome is not imported with this module
+        from pegasus_false_positive.utils.iosbackupcrypt import aes_unwrap_key
+
+        entry_path = self._entry_path(entry_id)
+        try:
+            with open(entry_path) as f:
+                entry = json.load(f)
+            if self.ttl is not None and time.time() - entry['created'] > self.ttl:
+                logger.debug('Cached key %s expired', entry_id[:8])
+                self.invalidate(entry_id)
+                return None
+            wrapped, salt = bytes.fromhex(entry['key']), bytes.fromhex(entry['salt'])
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError) as e:
+            logger.warning('Discarding corrupt cached key %s: %s', entry_id[:8], e)
+            self.invalidate(entry_id)
+            return None
+
+        try:
+            return aes_unwrap_key(self._wrapping_key(password, salt), wrapped)
+        except ValueError:
+            logger.debug('Cached key %s was stored with another password', entry_id[:8])
+            return None
+
+    def put(self, entry_id, key, password):
+        from pegasus_false_positive.utils.iosbackupcrypt import aes_wrap_key
+
+        self.path.mkdir(mode=0o700, parents=True, exist_ok=True)
+        # mkdir leaves the mode of an existing folder untouched
+        os.chmod(self.path, 0o700)
+        salt = os.urandom(WRAP_SALT_SIZE)
+        wrapped = aes_wrap_key(self._wrapping_key(password, salt), key)
+        entry_path = self._entry_path(entry_id)
+        tmp_path = entry_path.with_name(entry_path.name + '.tmp')
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'created': time.time(), 'salt': salt.hex(), 'key': wrapped.hex()}, f)
+        os.replace(tmp_path, entry_path)
+
+    def invalidate(self, entry_id):
+        self._entry_path(entry_id).unlink(missing_ok=True)
+
+    def clear(self):
+        if not self.path.is_dir():
+            return
+        for entry_path in self.path.glob('*.json'):
+            entry_path.unlink(missing_ok=True)
+        logger.info('Key cache %s cleared', self.path)
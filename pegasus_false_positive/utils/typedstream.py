@@ -0,0 +1,120 @@
+import struct
+
+# NeXTSTEP typedstream, the NSArchiver format of the message.attributedBody column
+
+STREAM_VERSION = 4
+SIGNATURE = b'streamtyped'
+SYSTEM_VERSION = 1000
+
+TAG_INT16 = 0x81
+TAG_INT32 = 0x82
+TAG_NEW = 0x84
+TAG_NIL = 0x85
+TAG_END = 0x86
+# Integers below this value are written as tags, references are counted from it
+REFERENCE_BASE = -110
+
+INT16 = struct.Struct('<h')
+INT32 = struct.Struct('<i')
+
+
+class TypedStreamWriter:
+    """
+    Encoder of typedstream values into a preallocated buffer. Shared strings (type encodings and class names) and
+    objects are numbered in two tables, so repeated ones are written as references.
+    """
+
+    def __init__(self, size_hint=512):
+        self.buffer = bytearray(size_hint)
+        self.position = 0
+        self.strings = {}
+        self.objects = {}
+        self.object_count = 0
+
+        self.write(bytes([STREAM_VERSION, len(SIGNATURE)]) + SIGNATURE)
+        self.write_int(SYSTEM_VERSION)
+
+    def write(self, data):
+        end = self.position + len(data)
+        if end > len(self.buffer):
+            self.buffer.extend(bytes(max(end - len(self.buffer), len(self.buffer))))
+        self.buffer[self.position:end] = data
+        self.position = end
+
+    def getvalue(self):
+        return bytes(self.buffer[:self.position])
+
+    def write_int(self, value):
+        if REFERENCE_BASE <= value <= 127:
+            self.write((value & 0xFF).to_bytes(1, 'big'))
+        elif -0x8000 <= value <= 0x7FFF:
+            self.write(bytes([TAG_INT16]) + INT16.pack(value))
+        else:
+            self.write(bytes([TAG_INT32]) + INT32.pack(value))
+
+    def write_reference(self, index):
+        self.write_int(REFERENCE_BASE + index)
+
+    def write_shared_string(self, value):
+        index = self.strings.get(value)
+        if index is not None:
+            self.write_reference(index)
+            return
+        self.strings[value] = len(self.strings)
+        self.write(bytes([TAG_NEW]))
+        self.write_int(len(value))
+        self.write(value)
+
+    def write_type(self, encoding):
+        self.write_shared_string(encoding.encode('ascii'))
+
+    def write_c_string(self, value):
+        """
+        Value of a "*" type.
+        """
+        self.write(bytes([TAG_NEW]))
+        self.write_shared_string(value.encode('utf-8'))
+
+    def write_bytes(self, value):
+        """
+        Value of a "+" type.
+        """
+        self.write_int(len(value))
+        self.write(value)
+
+    def write_object_reference(self, key):
+        """
+        Write a reference to the object registered with key, returns False if there is none.
+        """
+        index = self.objects.get(key)
+        if index is None:
+            return False
+        self.write_reference(index)
+        return True
+
+    def begin_object(self, classes, key=None):
+        """
+        Start a new object. classes is the (name, version) chain of its class up to NSObject; the classes already in
+        the stream are written as a reference. key registers the object for write_object_reference.
+        """
+        index = self._new_object()
+        if key is not None:
+            self.objects[key] = index
+
+        self.write(bytes([TAG_NEW]))
+        for name, version in classes:
+            if self.write_object_reference(('class', name)):
+                return
+            self.objects[('class', name)] = self._new_object()
+            self.write(bytes([TAG_NEW]))
+            self.write_shared_string(name.encode('ascii'))
+            self.write_int(version)
+        self.write(bytes([TAG_NIL]))
+
+    def end_object(self):
+        self.write(bytes([TAG_END]))
+
+    def _new_object(self):
+        index = self.object_count
+        self.object_count += 1
+        return index
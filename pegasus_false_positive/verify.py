@@ -0,0 +1,174 @@
+import argparse
+import collections
+import json
+import logging
+import os
+import pathlib
+import sys
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from pegasus_false_positive import db
+from pegasus_false_positive.db import Files, MBFile
+from pegasus_false_positive.utils import fileutils
+from pegasus_false_positive.utils.keycache import KeyCache
+
+logger = logging.getLogger("pegasus-false-positive")
+logger.setLevel(logging.DEBUG)
+log_handler = logging.StreamHandler()
+formatter = logging.Formatter('%(levelname)s - %(message)s')
+log_handler.setFormatter(formatter)
+
+FLAG_FILE = 1
+AES_BLOCK_SIZE = 16
+
+
+def expected_disk_size(size, encrypted):
+    # Encrypted files always carry PKCS#7 padding, between 1 and 16 bytes
+    if encrypted:
+        return size + AES_BLOCK_SIZE - size % AES_BLOCK_SIZE
+    return size
+
+
+def verify_file(backup_path, file_id, size, digest, encrypted, record_crc, previous_fingerprint):
+    """
+    Check a backup file against its Manifest record. Returns the error found, or None, and the fingerprint to store in
+    the checkpoint. Files whose fingerprint did not change since the checkpoint are not hashed again.
+    """
+    filename = fileutils.get_file_path_from_id(backup_path, file_id)
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return 'missing file', None
+
+    fingerprint = [stat.st_mtime_ns, stat.st_size, record_crc]
+    if fingerprint == previous_fingerprint:
+        return None, fingerprint
+
+    if stat.st_size != expected_disk_size(size, encrypted):
+        return 'size mismatch: %d bytes on disk, Manifest size %d' % (stat.st_size, size), None
+
+    # Records without a Digest can only be checked by size
+    if digest is None:
+        return None, fingerprint
+
+    file_digest, _ = fileutils.hash_file_mmap(filename)
+    if file_digest != digest:
+        return 'digest mismatch: %s on disk, Manifest digest %s' % (file_digest.hex(), digest.hex()), None
+
+    return None, fingerprint
+
+
+def load_checkpoint(checkpoint):
+    try:
+        with open(checkpoint) as f:
+            return json.load(f)['files']
+    except FileNotFoundError:
+        return {}
+
+
+def save_checkpoint(checkpoint, files):
+    with open(checkpoint, 'w') as f:
+        json.dump({'files': files}, f)
+
+
+def iter_manifest_files():
+    query = Files.select().where(Files.flags == FLAG_FILE).iterator()
+    for row in query:
+        record = MBFile.from_row(row)
+        yield record, zlib.crc32(record.blob)
+
+
+def verify(backup_path, jobs, previous=None):
+    """
+    Hash every file in the Manifest with a pool of jobs threads and return the errors found and the new checkpoint.
+    """
+    previous = previous or {}
+    errors = []
+    checkpoint = {}
+    pending = collections.deque()
+
+    def collect(future_record):
+        future, record = future_record
+        try:
+            error, fingerprint = future.result()
+        except Exception as e:
+            error, fingerprint = 'not checked: %s' % e, None
+        if error is not None:
+            logger.error('%s (%s-%s): %s', record.file_id, record.domain, record.relative_path, error)
+            errors.append((record.file_id, record.relative_path, error))
+        else:
+            checkpoint[record.file_id] = fingerprint
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for record, record_crc in iter_manifest_files():
+            encrypted = fileutils.get_encryption_key(record.attrs) is not None
+            future = executor.submit(verify_file, backup_path, record.file_id, record.size, record.digest, encrypted,
+                                     record_crc, previous.get(record.file_id))
+            pending.append((future, record))
+            # Keep a bounded window of files in flight, so the Manifest is streamed instead of loaded at once
+            if len(pending) >= jobs * 4:
+                collect(pending.popleft())
+
+        while pending:
+            collect(pending.popleft())
+
+    return errors, checkpoint
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="pegasus-false-positive-verify",
+                                     description='Check that every file in the Manifest exists with its size and digest',
+                                     exit_on_error=False)
+    parser.add_argument('--debug', action='store_true', help='activate debug mode')
+    parser.add_argument('--password', type=str, help='Backup Password')
+    parser.add_argument('--key-cache', type=str, help='folder to cache the key derived from the backup password')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='number of files hashed in parallel')
+    parser.add_argument('--checkpoint', type=str, help='json file where the verified files are recorded')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only check files modified since --checkpoint was recorded')
+    parser.add_argument('backup', type=str, help='iPhone backup folder')
+
+    args = parser.parse_args()
+    if args.incremental and not args.checkpoint:
+        parser.error('--incremental requires --checkpoint')
+
+    if not args.debug:
+        log_handler.setLevel(logging.INFO)
+
+    logger.addHandler(log_handler)
+
+    backup_path = args.backup
+
+    manifest_plist = fileutils.open_manifest_plist(backup_path)
+
+    if manifest_plist is None:
+        sys.exit(1)
+
+    file_locator = None
+    if manifest_plist['IsEncrypted']:
+        key_cache = KeyCache(args.key_cache) if args.key_cache else None
+        file_locator = fileutils.create_file_locator(manifest_plist, backup_path, password=args.password,
+                                                   key_cache=key_cache)
+
+    previous = None
+    if args.incremental:
+        previous = load_checkpoint(args.checkpoint)
+
+    manifest_db = db.MemoryDatabase(fileutils.read_manifest_db(backup_path, file_locator))
+
+    with db.open_manifest(manifest_db):
+        errors, checkpoint = verify(pathlib.Path(backup_path), max(args.jobs, 1), previous)
+
+    if args.checkpoint:
+        save_checkpoint(args.checkpoint, checkpoint)
+
+    if errors:
+        logger.error('%d files do not match the Manifest', len(errors))
+        sys.exit(1)
+
+    logger.info('%d files verified', len(checkpoint))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import io
+import os
+
+import pytest
+from Crypto.Cipher import AES
+
+from pegasus_false_positive.utils.iosbackupcrypt import CHUNK_SIZE, CryptUtil
+
+KEY = bytes(range(32))
+IV = bytes(16)
+SIZES = (0, 15, 16, 17, CHUNK_SIZE - 1, CHUNK_SIZE, CHUNK_SIZE + 1, 2 * CHUNK_SIZE + 17)
+
+decrypt_stream = CryptUtil._CryptUtil__aes_decrypt_cbc_stream
+encrypt_stream = CryptUtil._CryptUtil__aes_encrypt_cbc_stream
+
+
+def buffer_encrypt(data, padding):
+    """
+    Whole buffer implementation the streaming one replaced.
+    """
+    if padding:
+        pad = 16 - len(data) % 16
+        data += bytes([pad]) * pad
+    return AES.new(KEY, AES.MODE_CBC, IV).encrypt(data)
+
+
+def buffer_decrypt(data, padding):
+    data = AES.new(KEY, AES.MODE_CBC, IV).decrypt(data[:len(data) // 16 * 16])
+    return data[:-data[-1]] if padding else data
+
+
+def stream(function, data, padding):
+    dst = io.BytesIO()
+    function(io.BytesIO(data), dst, KEY, padding=padding)
+    return dst.getvalue()
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_padded_round_trip(size):
+    data = os.urandom(size)
+    encrypted = stream(encrypt_stream, data, True)
+    assert encrypted == buffer_encrypt(data, True)
+    assert stream(decrypt_stream, encrypted, True) == data == buffer_decrypt(encrypted, True)
+
+
+@pytest.mark.parametrize('size', [size for size in SIZES if size % 16 == 0])
+def test_unpadded_round_trip(size):
+    data = os.urandom(size)
+    encrypted = stream(encrypt_stream, data, False)
+    assert encrypted == buffer_encrypt(data, False)
+    assert stream(decrypt_stream, encrypted, False) == data
+
+
+@pytest.mark.parametrize('trailing', [1, 15])
+def test_decrypt_ignores_partial_block(trailing):
+    data = os.urandom(CHUNK_SIZE + 17)
+    encrypted = buffer_encrypt(data, True) + os.urandom(trailing)
+    assert stream(decrypt_stream, encrypted, True) == data == buffer_decrypt(encrypted, True)
+
+
+def test_decrypt_rejects_invalid_padding():
+    with pytest.raises(Exception, match='invalid padding'):
+        stream(decrypt_stream, buffer_encrypt(bytes(31) + b'\xff', False), True)
@@ -0,0 +1,81 @@
+import plistlib
+
+from pegasus_false_positive.db.manifest import MBFile
+from pegasus_false_positive.utils import bplist
+
+OLD_DIGEST = bytes(range(20))
+NEW_DIGEST = bytes(range(100, 120))
+ENCRYPTION_KEY = {'NS.data': b'\x03\x00\x00\x00' + bytes(range(40))}
+
+
+def archive(objects):
+    return {'$version': 100000, '$archiver': 'NSKeyedArchiver', '$top': {'root': plistlib.UID(1)},
+            '$objects': objects}
+
+
+def mbfile(digest_index=5, size=70000):
+    """
+    MBFile archive whose Digest, if any, is not $objects[3]: that one is the EncryptionKey.
+    """
+    record = {'$class': plistlib.UID(2), 'EncryptionKey': plistlib.UID(3), 'Size': size, 'ProtectionClass': 3}
+    objects = ['$null', record, {'$classname': 'MBFile', '$classes': ['MBFile', 'NSObject']}, ENCRYPTION_KEY,
+               'Library/SMS/sms.db']
+    if digest_index is not None:
+        record['Digest'] = plistlib.UID(digest_index)
+        objects.append(OLD_DIGEST)
+    return archive(objects)
+
+
+def test_patch_mbfile_in_place():
+    attrs = mbfile()
+    blob = plistlib.dumps(attrs, fmt=plistlib.FMT_BINARY)
+    patched = bplist.patch_mbfile(blob, NEW_DIGEST, 65000)
+    assert len(patched) == len(blob)
+
+    attrs['$objects'][5] = NEW_DIGEST
+    attrs['$objects'][1]['Size'] = 65000
+    assert plistlib.loads(patched) == attrs
+
+
+def test_patch_mbfile_without_digest_only_patches_size():
+    attrs = mbfile(digest_index=None)
+    patched = bplist.patch_mbfile(plistlib.dumps(attrs, fmt=plistlib.FMT_BINARY), NEW_DIGEST, 65000)
+
+    attrs['$objects'][1]['Size'] = 65000
+    assert plistlib.loads(patched) == attrs
+
+
+def test_patch_mbfile_returns_none_when_values_do_not_fit():
+    blob = plistlib.dumps(mbfile(), fmt=plistlib.FMT_BINARY)
+    # A longer digest, and a size that needs a wider integer
+    assert bplist.patch_mbfile(blob, NEW_DIGEST + b'\0', 65000) is None
+    assert bplist.patch_mbfile(blob, NEW_DIGEST, 1 << 40) is None
+
+
+def test_patch_mbfile_returns_none_for_shared_objects():
+    # plistlib writes equal integers once, so Size shares its object with the $version
+    blob = plistlib.dumps(mbfile(size=100000), fmt=plistlib.FMT_BINARY)
+    assert bplist.patch_mbfile(blob, NEW_DIGEST, 65000) is None
+
+
+def test_update_resolves_digest():
+    attrs = mbfile()
+    record = MBFile('abcdef', 'HomeDomain', 'Library/SMS/sms.db', 1, attrs,
+                    blob=plistlib.dumps(attrs, fmt=plistlib.FMT_BINARY))
+    record.update(NEW_DIGEST, 65000)
+
+    assert record.digest == NEW_DIGEST
+    assert record.attrs['$objects'][3] == ENCRYPTION_KEY
+    assert plistlib.loads(record.encode()) == record.attrs
+
+
+def test_update_without_digest_keeps_encryption_key():
+    attrs = mbfile(digest_index=None)
+    record = MBFile('abcdef', 'HomeDomain', 'Library/SMS/sms.db', 1, attrs,
+                    blob=plistlib.dumps(attrs, fmt=plistlib.FMT_BINARY))
+    record.update(NEW_DIGEST, 65000)
+
+    assert record.digest is None
+    assert record.size == 65000
+    assert record.attrs['$objects'][3] == ENCRYPTION_KEY
+    assert plistlib.loads(record.encode()) == record.attrs
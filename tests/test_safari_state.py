@@ -0,0 +1,44 @@
+import pytest
+
+from pegasus_false_positive.ioc.safari_state import insert_order
+
+
+def shift_and_insert(previous_indexes, new_indexes):
+    """
+    One UPDATE tabs SET order_index = order_index + 1 WHERE order_index >= ? per inserted tab.
+    """
+    indexes = dict(previous_indexes)
+    for key, order_index in new_indexes:
+        indexes = {tab: index + 1 if index >= order_index else index for tab, index in indexes.items()}
+        indexes[key] = order_index
+    return indexes
+
+
+@pytest.mark.parametrize('new_indexes', [
+    [('new', 0)],
+    [('new', 1)],
+    [('new', 2)],
+    [('new', 3)],
+    [('new', 9)],
+    [('a', 0), ('b', 0)],
+    [('a', 3), ('b', 1), ('c', 5)],
+    [('a', 9), ('b', 2), ('c', 2)],
+])
+def test_insert_order(new_indexes):
+    previous_indexes = {10: 0, 11: 1, 12: 2, 13: 3}
+    assert insert_order(previous_indexes, new_indexes) == shift_and_insert(previous_indexes, new_indexes)
+
+
+def test_insert_order_only_moves_tabs_after_insertion():
+    assert insert_order({10: 0, 11: 1, 12: 2}, [('new', 1)]) == {10: 0, 'new': 1, 11: 2, 12: 3}
+    assert insert_order({10: 0, 11: 1, 12: 2}, [('new', 5)]) == {10: 0, 11: 1, 12: 2, 'new': 5}
+
+
+def test_insert_order_with_gaps():
+    previous_indexes = {10: 0, 11: 4, 12: 4, 13: 8}
+    new_indexes = [('a', 2), ('b', 5), ('c', 0)]
+    assert insert_order(previous_indexes, new_indexes) == shift_and_insert(previous_indexes, new_indexes)
+
+
+def test_insert_order_in_empty_window():
+    assert insert_order({}, [('a', 0), ('b', 0)]) == {'a': 1, 'b': 0}
@@ -0,0 +1,37 @@
+import pytest
+
+from pegasus_false_positive.ioc import sms
+
+# resources/sms-template.bin, the attributedBody template encode_attributed_body replaced. Its runs are fixed: 11 UTF-16
+# units of text, the link, then 7 more units
+TEMPLATE = bytes.fromhex(
+    '040b73747265616d747970656481e803840140848484194e534d757461626c6541747472696275746564537472696e67'
+    '008484124e5341747472696275746564537472696e67008484084e534f626a6563740085928484840f4e534d75746162'
+    '6c65537472696e67018484084e53537472696e67019584012b534d535f4c454e475448534d535f544558548684026949'
+    '010b928484840c4e5344696374696f6e617279009584016901928498981d5f5f6b494d4d657373616765506172744174'
+    '747269627574654e616d658692848484084e534e756d626572008484074e5356616c7565009584012a849b9b00868699'
+    '024c494e4b5f4c454e47544892849a9b03928498981e5f5f6b494d446174614465746563746564417474726962757465'
+    '4e616d658692848484064e534461746100959b8142494e4152595f4c454e47544884065b42504c4953545f4c454e4754'
+    '48635d534d535f42504c49535486929b929c92849898165f5f6b494d4c696e6b4174747269627574654e616d65869284'
+    '8484054e5355524c009584016300928498984c494e4b5f4c454e4754484c494e4b86868699010786'
+)
+
+
+def template_attributed_body(text, url):
+    """
+    Fill the template the way Sms.generate_attributed_body did.
+    """
+    bplist = sms.link_bplist(url)
+    body = TEMPLATE.replace(b'SMS_BPLIST', bplist)
+    body = body.replace(b'SMS_TEXT', text.encode('utf-8'))
+    body = body.replace(b'SMS_LENGTH', len(text).to_bytes(1, 'big'))
+    body = body.replace(b'LINK_LENGTH', len(url).to_bytes(1, 'big'))
+    body = body.replace(b'LINK', url.encode('utf-8'))
+    body = body.replace(b'BPLIST_LENGTH', str(len(bplist)).encode('utf-8'))
+    return body.replace(b'BINARY_LENGTH', len(bplist).to_bytes(2, 'little'))
+
+
+@pytest.mark.parametrize('url', ['https://example.com/a', 'https://bit.ly/3xYz'])
+def test_encode_attributed_body_matches_template(url):
+    text = 'Your code: ' + url + ' thanks'
+    assert sms.encode_attributed_body(text, url) == template_attributed_body(text, url)
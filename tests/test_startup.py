@@ -0,0 +1,40 @@
+"""
+Startup guard: importing the command line tool must not import the IOC modules or the heavy dependencies only some of
+them need, so a run pays only for the IOCs it injects. Run it as a script to print the import time.
+"""
+import os
+import pathlib
+import subprocess
+import sys
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+LAZY_MODULES = ('Crypto', 'numpy', 'playhouse', 'pegasus_false_positive.ioc.')
+
+IMPORT_MAIN = '''
+import sys
+import time
+start = time.perf_counter()
+import pegasus_false_positive.main
+print(time.perf_counter() - start)
+print('\\n'.join(sys.modules))
+'''
+
+
+def import_main():
+    """
+    Import main in a fresh interpreter and return the seconds it took and the modules it imported.
+    """
+    env = dict(os.environ, PYTHONPATH=str(ROOT))
+    output = subprocess.run([sys.executable, '-c', IMPORT_MAIN], cwd=ROOT, env=env, check=True,
+                            capture_output=True, text=True).stdout.splitlines()
+    return float(output[0]), output[1:]
+
+
+def test_main_imports_no_ioc_modules():
+    _, modules = import_main()
+    assert [module for module in modules if module.startswith(LAZY_MODULES)] == []
+
+
+if __name__ == '__main__':
+    seconds, modules = import_main()
+    print('main imported in %.3f s, %d modules' % (seconds, len(modules)))
@@ -0,0 +1,56 @@
+"""
+A backup file that fails to decrypt must be left as it is: never encrypted again nor updated in the Manifest.
+"""
+import plistlib
+
+import pytest
+from Crypto.Cipher import AES
+
+from pegasus_false_positive.ioc.baseioc import BaseIOC
+from pegasus_false_positive.utils.fileutils import FileLocatorBackupEncrypted
+from pegasus_false_positive.utils.iosbackupcrypt import CryptUtil
+
+KEY = bytes(range(32))
+PROTECTION_CLASS = 3
+
+
+class RecordsIOC(BaseIOC):
+    def insert_records(self):
+        pass
+
+
+def file_locator(backup_path):
+    crypt = CryptUtil.__new__(CryptUtil)
+    # Every file key unwraps to KEY, so no keybag is needed
+    crypt._CryptUtil__unwrap_key_for_class = lambda protection_class, key: KEY
+    locator = FileLocatorBackupEncrypted.__new__(FileLocatorBackupEncrypted)
+    locator.backup_path = backup_path
+    locator.crypt = crypt
+    return locator
+
+
+def encrypted_attrs():
+    return {'$objects': ['$null',
+                         {'EncryptionKey': plistlib.UID(2), 'ProtectionClass': PROTECTION_CLASS, 'Size': 0},
+                         {'NS.data': PROTECTION_CLASS.to_bytes(4, 'little') + bytes(40)}]}
+
+
+@pytest.mark.parametrize('in_memory', [False, True])
+def test_file_that_fails_to_decrypt_is_not_written_back(tmp_path, in_memory):
+    # The last plaintext byte, 0xff, is not a valid padding length
+    ciphertext = AES.new(KEY, AES.MODE_CBC, bytes(16)).encrypt(bytes(4095) + b'\xff')
+    filename = tmp_path / 'ab' / 'abcdef'
+    filename.parent.mkdir()
+    filename.write_bytes(ciphertext)
+
+    ioc = RecordsIOC(tmp_path, file_locator(tmp_path), in_memory=in_memory)
+    ioc.filename = filename
+    ioc.attrs = encrypted_attrs()
+
+    with pytest.raises(Exception, match='invalid padding'):
+        ioc.insert_chunk([{}])
+    ioc.finish_chunks()
+
+    assert filename.read_bytes() == ciphertext
+    assert list(tmp_path.glob('ab/*')) == [filename]
+    assert ioc.manifest_updates == []